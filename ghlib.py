@@ -1,23 +1,378 @@
 # library of GitHub related functions
+import collections
+import concurrent.futures
 import datetime
+import email.utils
+import functools
+import hashlib
 import json
+import pathlib
+import random
+import socket
+import sqlite3
+import threading
+import time
+import types
+import typing
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import urllib3
+from urllib3.util import Retry
 
-from error_handling import error
+from error_handling import error, warn
 import repoinfo
 from repoinfo import RepoInfo
 
+# orjson parses the large workflow run payloads considerably faster than
+# the json module, use it when it's available
+_json_loads: typing.Callable[..., typing.Any]
+_json_dumps: typing.Callable[..., str | bytes]
+try:
+  import orjson
+  _json_loads = orjson.loads
+  _json_dumps = orjson.dumps
+except ImportError:
+  _json_loads = json.loads
+  _json_dumps = json.dumps
 
+# maximum number of requests to have in flight to GitHub at once, keeps
+# concurrent queries below GitHub's secondary rate limits
+MAX_CONCURRENT_REQUESTS = 20
+
+# GitHub asks that content creating requests aren't made concurrently, so
+# tagging runs far fewer of them at once than reads
+MAX_CONCURRENT_WRITES = 4
+
+# thread pool shared by the functions polling workflows so that repeated
+# refreshes don't start new threads each time
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+GITHUB_REPOS_URL = "https://api.github.com/repos/"
+
+# installation tokens for GitHub Apps keyed by (app id, installation id), each
+# entry holds the token and its expiration time
+_INSTALLATION_TOKENS: dict[tuple[str, str], tuple[str, datetime.datetime]] = {}
+# refresh installation tokens this long before GitHub expires them
+INSTALLATION_TOKEN_MARGIN = datetime.timedelta(minutes=5)
+# credentials of GitHub Apps keyed by the stand-in token returned by
+# app_installation_token, requests made with a stand-in token use a current
+# installation token for the app
+_APP_INSTALLATIONS: dict[str, tuple[str, str, str]] = {}
+_APP_INSTALLATIONS_LOCK = threading.Lock()
+APP_TOKEN_PREFIX = "app-installation:"
+
+# settings for retrying requests that fail due to connection problems or rate limits
+MAX_RETRIES = 6
+RETRY_BACKOFF = 1
+MAX_RETRY_WAIT = 64
+# GitHub asks clients to wait at least a minute after hitting a secondary rate limit
+SECONDARY_RATE_LIMIT_WAIT = 60
+# (connect, read) timeouts in seconds so a stalled connection can't hang the tool
+REQUEST_TIMEOUT = (5, 30)
+
+# shared session so that connections to GitHub are kept alive and pooled
+# between requests instead of doing a new TLS handshake for every call
+# server errors on idempotent requests are retried by urllib3, connection
+# problems and rate limits are handled by retry_request
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50,
+                                      max_retries=Retry(total=MAX_RETRIES, connect=0, read=0,
+                                                        backoff_factor=RETRY_BACKOFF,
+                                                        status_forcelist=[500, 502, 503, 504],
+                                                        respect_retry_after_header=True,
+                                                        raise_on_status=False)))
+SESSION.headers.update({'Accept': 'application/vnd.github.v3+json'})
+
+# client side limit on request rate, GitHub's secondary rate limit allows
+# about 900 REST requests a minute, bursts above that get requests rejected
+REQUEST_RATE = 15
+REQUEST_BURST = 30
+# lowest request rate to drop to after hitting rate limits
+MIN_REQUEST_RATE = 0.1
+# successful requests needed before increasing a reduced request rate
+RATE_RECOVERY_REQUESTS = 20
+# fraction of the primary rate limit left at which requests are spread out
+# over the time until the limit resets
+RATE_LIMIT_LOW_WATER = 0.1
+
+# methods that can safely be resent if the connection drops after the
+# request may have reached GitHub
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# cache of (url, token) -> (etag, response) used to make conditional GET
+# requests, 304 responses from GitHub don't count against the rate limit.
+# GitHub's responses vary with the token used so it is part of the key
+ETAG_CACHE_SIZE = 1024
+_ETAG_CACHE: collections.OrderedDict[tuple[str, str | None], tuple[str, requests.Response]] = \
+  collections.OrderedDict()
+_ETAG_LOCK = threading.Lock()
+
+# optional on disk copy of the ETag cache so that later runs of the tool can
+# make conditional requests from the start, enabled with enable_disk_cache
+DISK_CACHE_PATH = pathlib.Path("~/.cache/ssl-hep-release-tool/etags.sqlite").expanduser()
+_DISK_CACHE: sqlite3.Connection | None = None
+_DISK_CACHE_LOCK = threading.Lock()
+# responses not used for this many seconds are dropped, as are the least
+# recently used ones beyond the row limit
+DISK_CACHE_MAX_AGE = 14 * 24 * 60 * 60
+DISK_CACHE_MAX_ROWS = 5000
+
+# GET requests currently in flight, keyed by (url, token)
+_INFLIGHT: dict[tuple[str, str | None], concurrent.futures.Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+class RateLimiter:
+  """
+  Token bucket limiting how quickly requests are sent to GitHub, the rate is
+  halved when GitHub reports a rate limit, recovers after a run of successful
+  requests and is reduced when the primary rate limit is nearly used up
+  """
+
+  def __init__(self, rate: float, burst: int):
+    """
+    Create a rate limiter
+    :param rate: maximum number of requests per second
+    :param burst: number of requests that can be sent at once
+    """
+    self.max_rate = rate
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.successes = 0
+    self.lock = threading.Lock()
+
+  def acquire(self) -> None:
+    """
+    Wait until a request can be sent
+    :return: None
+    """
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      # take the token now so callers waiting at the same time queue up behind each other
+      self.tokens -= 1
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+    if wait:
+      time.sleep(wait)
+
+  def update(self, r: requests.Response) -> None:
+    """
+    Adjust the request rate using a response from GitHub
+    :param r: response from GitHub
+    :return: None
+    """
+    with self.lock:
+      if rate_limit_wait(r):
+        self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+        self.successes = 0
+        return
+      ceiling = self.max_rate
+      try:
+        limit = int(r.headers['X-RateLimit-Limit'])
+        remaining = int(r.headers['X-RateLimit-Remaining'])
+        reset = float(r.headers['X-RateLimit-Reset'])
+        if remaining < limit * RATE_LIMIT_LOW_WATER:
+          ceiling = max(MIN_REQUEST_RATE, min(ceiling, remaining / max(1.0, reset - time.time())))
+      except (KeyError, ValueError):
+        pass
+      self.successes += 1
+      if self.successes >= RATE_RECOVERY_REQUESTS:
+        self.rate *= 2
+        self.successes = 0
+      self.rate = min(self.rate, ceiling)
+
+
+_RATE_LIMITER = RateLimiter(REQUEST_RATE, REQUEST_BURST)
+
+
+def rate_limit_wait(r: requests.Response, attempt: int = 0) -> float:
+  """
+  Check a response from GitHub to see if a rate limit was hit
+  :param r: response from GitHub
+  :param attempt: number of times the request has already been retried
+  :return: number of seconds to wait before retrying, 0 if no rate limit was hit
+  """
+  if r.status_code not in [403, 429]:
+    return 0
+  if 'Retry-After' in r.headers:
+    retry_after = r.headers['Retry-After']
+    try:
+      return float(retry_after)
+    except ValueError:
+      try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_time.timestamp() - time.time())
+      except (TypeError, ValueError):
+        pass
+  if r.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in r.headers:
+    return max(0.0, float(r.headers['X-RateLimit-Reset']) - time.time()) + 1
+  if r.status_code == 429 or 'secondary rate limit' in r.text.lower():
+    return SECONDARY_RATE_LIMIT_WAIT * 2 ** attempt
+  return 0
+
+
+def connect_failed(err: requests.exceptions.RequestException) -> bool:
+  """
+  Check whether a request failed before a connection to the server was made,
+  in which case the request can't have been processed
+  :param err: exception raised by requests
+  :return: True if the connection couldn't be established
+  """
+  if isinstance(err, requests.exceptions.ConnectTimeout):
+    return True
+  if isinstance(err, requests.exceptions.ConnectionError) and err.args:
+    reason = getattr(err.args[0], 'reason', err.args[0])
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+  return False
+
+
+def name_resolution_failed(err: requests.exceptions.RequestException) -> bool:
+  """
+  Check whether a request failed because the server's name couldn't be
+  resolved, which usually means there's no network so retrying won't help
+  :param err: exception raised by requests
+  :return: True if name resolution failed
+  """
+  seen = set()
+  pending: list[typing.Optional[BaseException]] = [err]
+  while pending:
+    exc = pending.pop()
+    if exc is None or id(exc) in seen:
+      continue
+    if isinstance(exc, socket.gaierror):
+      return True
+    seen.add(id(exc))
+    pending.extend([exc.__cause__, exc.__context__, getattr(exc, 'reason', None)])
+    pending.extend(arg for arg in exc.args if isinstance(arg, BaseException))
+  return False
+
+
+def retry_request(func: typing.Callable[..., requests.Response]) \
+        -> typing.Callable[..., requests.Response]:
+  """
+  Decorator that retries a request with exponential backoff on connection
+  problems and waits for rate limits to reset before retrying, requests
+  that aren't idempotent are only resent if they never reached the server
+  and failures to resolve the server's name aren't retried at all
+  :param func: function taking the HTTP method as its first argument and
+               returning the response
+  :return: wrapped function
+  """
+  @functools.wraps(func)
+  def wrapper(method: str, *args, **kwargs) -> requests.Response:
+    attempt = 0
+    while True:
+      try:
+        r = func(method, *args, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+        if attempt >= MAX_RETRIES or name_resolution_failed(err) or \
+           (method.upper() not in IDEMPOTENT_METHODS and not connect_failed(err)):
+          raise
+        # jitter the backoff so concurrent requests don't all retry at once
+        wait = random.uniform(0.5, 1) * min(MAX_RETRY_WAIT, RETRY_BACKOFF * 2 ** attempt)
+        warn(f"Problem connecting to GitHub ({err}), retrying in {wait:.1f}s")
+        time.sleep(wait)
+        attempt += 1
+        continue
+      wait = rate_limit_wait(r, attempt)
+      if wait == 0 or attempt >= MAX_RETRIES:
+        return r
+      warn(f"Hit GitHub rate limit, retrying in {wait:.0f}s")
+      time.sleep(wait)
+      attempt += 1
+  return wrapper
+
+
+def auth_headers(token: str = None) -> types.MappingProxyType:
+  """
+  Get the headers needed to authenticate with GitHub, headers are built
+  once per token and shared so they must not be modified
+  :param token: GitHub personal access token or token from app_installation_token
+  :return: read only mapping with authentication headers
+  """
+  return token_headers(resolve_token(token))
+
+
+@functools.lru_cache(maxsize=8)
+def token_headers(token: str = None) -> types.MappingProxyType:
+  """
+  Build the authentication headers for a token
+  :param token: token to send to GitHub
+  :return: read only mapping with authentication headers
+  """
+  if not token:
+    return types.MappingProxyType({})
+  return types.MappingProxyType({'Authorization': f"token {token}"})
+
+
+def response_json(r: requests.Response) -> typing.Any:
+  """
+  Decode the JSON body of a response from GitHub
+  :param r: response from GitHub
+  :return: decoded JSON body
+  """
+  return _json_loads(r.content)
+
+
+def error_detail(r: requests.Response) -> typing.Any:
+  """
+  Get the details GitHub gave for a failed request
+  :param r: response from GitHub
+  :return: decoded JSON body, or the raw text if the body isn't JSON
+  """
+  try:
+    return response_json(r)
+  except ValueError:
+    return r.text
+
+
+@retry_request
+def request(method: str, url: str, **kwargs) -> requests.Response:
+  """
+  Send a request to GitHub using the shared session
+  :param method: HTTP method to use
+  :param url: url to send request to
+  :param kwargs: additional arguments passed to requests
+  :return: results from request
+  """
+  kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+  if 'json' in kwargs:
+    # encode JSON bodies here so that orjson is used when available
+    body = _json_dumps(kwargs.pop('json'))
+    kwargs['data'] = body.encode() if isinstance(body, str) else body
+    kwargs['headers'] = {**kwargs.get('headers', {}), 'Content-Type': 'application/json'}
+  _RATE_LIMITER.acquire()
+  r = SESSION.request(method, url, **kwargs)
+  _RATE_LIMITER.update(r)
+  if method.upper() != 'GET' and r.ok and url.startswith(GITHUB_REPOS_URL):
+    # changes to a repo can make any cached response for it stale
+    invalidate_cache("/".join(url.split("/")[:6]) + "/")
+  return r
+
+
+# prefixes used by classic and fine-grained PATs, OAuth, app installation
+# and refresh tokens
+GITHUB_TOKEN_PREFIXES = ('ghp_', 'github_pat_', 'gho_', 'ghs_', 'ghr_')
+
+
+@functools.lru_cache(maxsize=8)
 def valid_gh_token(token: str = None, query: bool = True) -> bool:
   """
   Check to make sure token might be a GitHub token, function can't verify for sure
-  that a token is valid, just that it is not valid
+  that a token is valid, just that it is not valid.  Results are cached so
+  repeated checks of the same token don't query GitHub again
   :param token: string with token
   :param query: query GitHub to really valid
   :return: false if token is not valid, true if it might be
   """
-  if token and token.startswith('ghp'):
+  token = resolve_token(token)
+  if token and token.startswith(GITHUB_TOKEN_PREFIXES):
     if query:
       resp = get("https://api.github.com/")
       if resp.status_code == 200:
@@ -29,17 +384,237 @@ def valid_gh_token(token: str = None, query: bool = True) -> bool:
   return False
 
 
+def get_installation_token(app_id: str, private_key: str, installation_id: str) -> str:
+  """
+  Get an installation token for a GitHub App, these have a higher rate limit
+  than personal access tokens.  Tokens are reused until they are close to
+  expiring
+  :param app_id: id of the GitHub App
+  :param private_key: PEM encoded private key of the GitHub App
+  :param installation_id: id of the app's installation on the organization
+  :return: installation token, empty string if one couldn't be created
+  """
+  now = datetime.datetime.now(datetime.timezone.utc)
+  cached = _INSTALLATION_TOKENS.get((app_id, installation_id))
+  if cached and cached[1] - now > INSTALLATION_TOKEN_MARGIN:
+    return cached[0]
+  try:
+    import jwt
+  except ImportError:
+    error("PyJWT must be installed to authenticate as a GitHub App", abort=False)
+    return ""
+  # backdate the issue time to allow for clock drift, GitHub limits JWTs to 10 minutes
+  issued = int(time.time()) - 60
+  app_jwt = jwt.encode({'iat': issued, 'exp': issued + 600, 'iss': app_id},
+                       private_key, algorithm='RS256')
+  r = request('POST', f"https://api.github.com/app/installations/{installation_id}/access_tokens",
+              headers={'Authorization': f"Bearer {app_jwt}"})
+  if r.status_code != 201:
+    error(f"Got a {r.status_code} while creating an installation token for app {app_id}",
+          abort=False)
+    return ""
+  resp = response_json(r)
+  expires = parse_timestamp(resp['expires_at'])
+  _INSTALLATION_TOKENS[(app_id, installation_id)] = (resp['token'], expires)
+  return resp['token']
+
+
+def app_installation_token(app_id: str, private_key: str, installation_id: str) -> str:
+  """
+  Get a token for a GitHub App installation that can be used with the
+  functions in this module in place of a personal access token.  Installation
+  tokens expire after an hour so requests made with the returned token get a
+  current installation token from get_installation_token each time
+  :param app_id: id of the GitHub App
+  :param private_key: PEM encoded private key of the GitHub App
+  :param installation_id: id of the app's installation on the organization
+  :return: token standing in for the installation tokens, empty string if
+           an installation token couldn't be created
+  """
+  if not get_installation_token(app_id, private_key, installation_id):
+    return ""
+  token = f"{APP_TOKEN_PREFIX}{app_id}/{installation_id}"
+  _APP_INSTALLATIONS[token] = (app_id, private_key, installation_id)
+  return token
+
+
+def resolve_token(token: str = None) -> str | None:
+  """
+  Get the token to send to GitHub for a token used with this module
+  :param token: GitHub personal access token or token from app_installation_token
+  :return: the token itself or a current installation token for stand-in tokens
+  """
+  credentials = _APP_INSTALLATIONS.get(token) if token else None
+  if credentials is None:
+    return token
+  # only one thread refreshes an expiring token, the others reuse the new one
+  with _APP_INSTALLATIONS_LOCK:
+    return get_installation_token(*credentials)
+
+
+def enable_disk_cache(path: pathlib.Path = DISK_CACHE_PATH) -> None:
+  """
+  Keep ETags and responses from GitHub on disk so they can be reused by
+  later runs
+  :param path: path to the sqlite database used for the cache
+  :return: None
+  """
+  global _DISK_CACHE
+  # responses can include data from private repos so only the user can read them
+  path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+  path.parent.chmod(0o700)
+  path.touch(mode=0o600, exist_ok=True)
+  path.chmod(0o600)
+  connection = sqlite3.connect(path, check_same_thread=False)
+  with connection:
+    # etags is the table used before responses expired
+    connection.execute("DROP TABLE IF EXISTS etags")
+    connection.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT, token TEXT, etag TEXT, "
+                       "status INTEGER, headers TEXT, body BLOB, used REAL, "
+                       "PRIMARY KEY (url, token))")
+    connection.execute("DELETE FROM responses WHERE used < ?",
+                       (time.time() - DISK_CACHE_MAX_AGE,))
+    connection.execute("DELETE FROM responses WHERE rowid NOT IN "
+                       "(SELECT rowid FROM responses ORDER BY used DESC LIMIT ?)",
+                       (DISK_CACHE_MAX_ROWS,))
+  with _DISK_CACHE_LOCK:
+    _DISK_CACHE = connection
+
+
+def disk_cache_key(token: str | None) -> str:
+  """
+  Get the value used to identify a token in the disk cache, tokens are
+  hashed so that they aren't written to disk
+  :param token: GitHub token
+  :return: hash of the token
+  """
+  return hashlib.sha256((token or "").encode()).hexdigest()
+
+
+def disk_cache_load(url: str, token: str | None) -> tuple[str, requests.Response] | None:
+  """
+  Load a cached response from the disk cache
+  :param url: url of the cached response
+  :param token: GitHub token used for the request
+  :return: tuple with the ETag and response, None if nothing was cached
+  """
+  with _DISK_CACHE_LOCK:
+    if _DISK_CACHE is None:
+      return None
+    row = _DISK_CACHE.execute("SELECT etag, status, headers, body FROM responses "
+                              "WHERE url = ? AND token = ?",
+                              (url, disk_cache_key(token))).fetchone()
+    if row is not None:
+      with _DISK_CACHE:
+        _DISK_CACHE.execute("UPDATE responses SET used = ? WHERE url = ? AND token = ?",
+                            (time.time(), url, disk_cache_key(token)))
+  if row is None:
+    return None
+  r = requests.Response()
+  r.url = url
+  r.status_code = row[1]
+  r.headers = CaseInsensitiveDict(json.loads(row[2]))
+  r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+  r._content = row[3]
+  return row[0], r
+
+
+def disk_cache_store(url: str, token: str | None, r: requests.Response) -> None:
+  """
+  Save a response with an ETag to the disk cache
+  :param url: url of the response
+  :param token: GitHub token used for the request
+  :param r: response to save
+  :return: None
+  """
+  with _DISK_CACHE_LOCK:
+    if _DISK_CACHE is None:
+      return
+    with _DISK_CACHE:
+      _DISK_CACHE.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (url, disk_cache_key(token), r.headers['ETag'], r.status_code,
+                           json.dumps(dict(r.headers)), r.content, time.time()))
+
+
+def invalidate_cache(prefix: str) -> None:
+  """
+  Drop cached responses for urls starting with a prefix
+  :param prefix: url prefix to invalidate
+  :return: None
+  """
+  with _ETAG_LOCK:
+    for key in [key for key in _ETAG_CACHE if key[0].startswith(prefix)]:
+      del _ETAG_CACHE[key]
+  with _DISK_CACHE_LOCK:
+    if _DISK_CACHE is None:
+      return
+    with _DISK_CACHE:
+      _DISK_CACHE.execute("DELETE FROM responses WHERE substr(url, 1, ?) = ?",
+                          (len(prefix), prefix))
+
+
 def get(url: str, token: str = None) -> requests.Response:
   """
-  Send a GET request to GitHub
+  Send a GET request to GitHub, identical requests made while one is
+  already in flight wait for and share its response
   :param url: url to GET
   :param token: GitHub personal access token
   :return: results from request
   """
-  get_headers = {'Accept': 'application/vnd.github.v3+json'}
-  if token:
-    get_headers['Authorization'] = f"token {token}"
-  return requests.get(url, headers=get_headers)
+  key = (url, token)
+  with _INFLIGHT_LOCK:
+    pending = _INFLIGHT.get(key)
+    if pending is None:
+      future: concurrent.futures.Future[requests.Response] = concurrent.futures.Future()
+      _INFLIGHT[key] = future
+  if pending is not None:
+    return pending.result()
+  try:
+    r = conditional_get(url, token)
+    future.set_result(r)
+    return r
+  except BaseException as err:
+    future.set_exception(err)
+    raise
+  finally:
+    with _INFLIGHT_LOCK:
+      del _INFLIGHT[key]
+
+
+def conditional_get(url: str, token: str = None) -> requests.Response:
+  """
+  Send a GET request to GitHub, if a prior response for the url had an ETag
+  a conditional request is made and the cached response is returned if
+  the resource hasn't changed
+  :param url: url to GET
+  :param token: GitHub personal access token
+  :return: results from request
+  """
+  get_headers = dict(auth_headers(token))
+  cache_key = (url, token)
+  with _ETAG_LOCK:
+    cached = _ETAG_CACHE.get(cache_key)
+  if cached is None:
+    cached = disk_cache_load(url, token)
+  if cached:
+    get_headers['If-None-Match'] = cached[0]
+  r = request('GET', url, headers=get_headers)
+  if r.status_code == 304 and cached:
+    with _ETAG_LOCK:
+      # responses loaded from disk are kept in memory from then on
+      _ETAG_CACHE[cache_key] = cached
+      _ETAG_CACHE.move_to_end(cache_key)
+      if len(_ETAG_CACHE) > ETAG_CACHE_SIZE:
+        _ETAG_CACHE.popitem(last=False)
+    return cached[1]
+  if r.status_code == 200 and 'ETag' in r.headers:
+    with _ETAG_LOCK:
+      _ETAG_CACHE[cache_key] = (r.headers['ETag'], r)
+      _ETAG_CACHE.move_to_end(cache_key)
+      if len(_ETAG_CACHE) > ETAG_CACHE_SIZE:
+        _ETAG_CACHE.popitem(last=False)
+    disk_cache_store(url, token, r)
+  return r
 
 
 def post(url: str, data: dict, token: str = None) -> requests.Response:
@@ -50,10 +625,27 @@ def post(url: str, data: dict, token: str = None) -> requests.Response:
   :param token: GitHub personal access token
   :return: results from request
   """
-  headers = {'Accept': 'application/vnd.github.v3+json'}
-  if token:
-    headers['Authorization'] = f"token {token}"
-  return requests.post(url, data=data, headers=headers)
+  return request('POST', url, data=data, headers=auth_headers(token))
+
+
+def graphql(query: str, variables: dict = None, token: str = None) -> dict:
+  """
+  Send a query to the GitHub GraphQL API
+  :param query: GraphQL query document
+  :param variables: dictionary with values for variables used in the query
+  :param token: GitHub personal access token
+  :return: dictionary with the data returned by the query, empty if the query failed
+  """
+  r = request('POST', GITHUB_GRAPHQL_URL,
+              json={'query': query, 'variables': variables or {}},
+              headers=auth_headers(token))
+  if r.status_code != 200:
+    error(f"Got a {r.status_code} while querying the GitHub GraphQL API", abort=False)
+    return {}
+  resp = response_json(r)
+  for err in resp.get('errors', []):
+    warn(f"GitHub GraphQL API error: {err.get('message')}")
+  return resp.get('data') or {}
 
 
 def verify_commit(repo_url: str, commit: str, token: str = None) -> bool:
@@ -81,58 +673,78 @@ def verify_commit(repo_url: str, commit: str, token: str = None) -> bool:
   return False
 
 
-def tag_repo(repo_config: RepoInfo, token: str = None) -> bool:
+def create_tag_object(repo_config: RepoInfo, token: str = None, verify: bool = True) -> str:
   """
-  Tag a repo branch
+  Create an annotated tag object for the commit given in the repo config,
+  the tag still needs a ref created for it to show up in the repo
   :param repo_config: configuration for repo
   :param token: GitHub token for authentication
-  :return: None
+  :param verify: check that the commit exists before tagging it, can be
+                 skipped if the commit was just looked up on GitHub
+  :return: sha of the tag object created, empty string on failure
   """
-
-  if not valid_gh_token(token):
-    error("Must provide a valid github token for authentication", abort=False)
-    return False
-
+  # the token is checked once by the caller rather than for every repo tagged
   if not repo_config.commit:
     error(f"No commit information found for {repo_config.name}", abort=False)
-    return False
-  if not verify_commit(repoinfo.generate_repo_url(repo_config), repo_config.commit, token):
+    return ""
+  if verify and \
+     not verify_commit(repoinfo.generate_repo_url(repo_config), repo_config.commit, token):
     error(f"Can't verify commit {repo_config.commit} exists for {repo_config.name}", abort=False)
-    return False
-  r = requests.post(repoinfo.generate_repo_url(repo_config) + "/git/tags",
-                    data=json.dumps({"owner": "ssl-hep",
-                                     "repo": repo_config.name,
-                                     "tag": repo_config.tag,
-                                     "message": "Tagged using release_tool.py",
-                                     "object": repo_config.commit,
-                                     "type": "commit"}),
-                    headers={'Accept': 'application/vnd.github.v3+json',
-                             'Authorization': f"token {token}"})
+    return ""
+  r = request('POST', repoinfo.generate_repo_url(repo_config) + "/git/tags",
+              json={"tag": repo_config.tag,
+                    "message": "Tagged using release_tool.py",
+                    "object": repo_config.commit,
+                    "type": "commit"},
+              headers=auth_headers(token))
 
   if r.status_code != 201:
     if r.status_code == 404:
-      error(f"Got a 404 while creating a tag for a {repo_config.name}, check to see if you have write access "
-            f"to this repo",
+      error(f"Got a 404 while creating a tag for a {repo_config.name}, check to see if you "
+            f"have write access to this repo",
             abort=False)
-      error(f"Error while creating a tag for a {repo_config.name} "
-            f"commit: {repo_config.commit}: {r.json()}")
-
     error(f"Error while creating a tag for a {repo_config.name} "
-          f"commit: {repo_config.commit}: {r.json()}")
-    return False
-  resp = r.json()
-  tag_sha = resp["sha"]
-  r = requests.post(repoinfo.generate_repo_url(repo_config) + "/git/refs",
-                    data=json.dumps({"ref": f"refs/tags/{repo_config.tag}",
-                                     "sha": tag_sha}),
-                    headers={'Accept': 'application/vnd.github.v3+json',
-                             'Authorization': f"token {token}"})
+          f"commit: {repo_config.commit}: {error_detail(r)}",
+          abort=False)
+    return ""
+  resp = response_json(r)
+  return resp["sha"]
+
+
+def create_tag_ref(repo_config: RepoInfo, tag_sha: str, token: str = None) -> bool:
+  """
+  Create the ref for a tag object so that the tag is visible in the repo
+  :param repo_config: configuration for repo
+  :param tag_sha: sha of the tag object
+  :param token: GitHub token for authentication
+  :return: True on success, False otherwise
+  """
+  r = request('POST', repoinfo.generate_repo_url(repo_config) + "/git/refs",
+              json={"ref": f"refs/tags/{repo_config.tag}",
+                    "sha": tag_sha},
+              headers=auth_headers(token))
   if r.status_code != 201:
-    error(f"Error while creating a ref for a {repo_config.name} commit: {tag_sha}: {r.json()}")
+    error(f"Error while creating a ref for a {repo_config.name} commit: {tag_sha}: "
+          f"{error_detail(r)}",
+          abort=False)
     return False
   return True
 
 
+def tag_repo(repo_config: RepoInfo, token: str = None, verify: bool = True) -> bool:
+  """
+  Tag a repo branch
+  :param repo_config: configuration for repo
+  :param token: GitHub token for authentication
+  :param verify: check that the commit exists before tagging it
+  :return: True if the repo was tagged
+  """
+  tag_sha = create_tag_object(repo_config, token, verify)
+  if not tag_sha:
+    return False
+  return create_tag_ref(repo_config, tag_sha, token)
+
+
 def get_repo_workflow_by_tag(repo_config: RepoInfo, tag: str, token: str = None) -> list[str]:
   """
   Get a list of workflows to monitor for a given tag and repo
@@ -146,7 +758,7 @@ def get_repo_workflow_by_tag(repo_config: RepoInfo, tag: str, token: str = None)
 
   repo_url = repoinfo.generate_repo_url(repo_config) + f"/actions/runs?event=push&branch={tag}"
   r = get(repo_url, token)
-  resp = r.json()
+  resp = response_json(r)
   if r.status_code != 200:
     if r.status_code == 404:
       error(f"Got a 404 while looking for workflow runs {repo_config.name}, check to see if you have access "
@@ -163,6 +775,121 @@ def get_repo_workflow_by_tag(repo_config: RepoInfo, tag: str, token: str = None)
   return urls
 
 
+def parse_timestamp(timestamp: str) -> datetime.datetime:
+  """
+  Parse an ISO8601 timestamp returned by GitHub
+  :param timestamp: string with timestamp (e.g. 2022-02-16T09:18:00Z)
+  :return: timezone aware datetime
+  """
+  return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def get_branch_commits(repo_configs: list[RepoInfo], token: str = None) -> dict[str, str | None]:
+  """
+  Get the last commit on the configured branch of several repos using a
+  single GraphQL query
+  :param repo_configs: list of repo configurations
+  :param token: github token, GitHub's GraphQL API requires authentication
+  :return: dictionary mapping repo names to commit hashes, None if the branch
+           doesn't exist, repos the query couldn't resolve are left out
+  """
+  repos = [repo for repo in repo_configs if repo.branch]
+  if not token or not repos:
+    return {}
+  repo_queries = []
+  variables = {'owner': repoinfo.GITHUB_ORGANIZATION}
+  for i, repo in enumerate(repos):
+    repo_queries.append(f"r{i}: repository(owner: $owner, name: $name{i}) "
+                        f"{{ ref(qualifiedName: $branch{i}) {{ target {{ oid }} }} }}")
+    variables[f"name{i}"] = repo.name
+    variables[f"branch{i}"] = f"refs/heads/{repo.branch}"
+  declarations = "".join(f", $name{i}: String!, $branch{i}: String!" for i in range(len(repos)))
+  query = f"query($owner: String!{declarations}) {{\n" + "\n".join(repo_queries) + "\n}"
+  data = graphql(query, variables, token)
+
+  commits: dict[str, str | None] = {}
+  for i, repo in enumerate(repos):
+    repo_data = data.get(f"r{i}")
+    if repo_data is None:
+      continue
+    commits[repo.name] = repo_data['ref']['target']['oid'] if repo_data['ref'] else None
+  return commits
+
+
+def get_workflows_by_tag(repo_configs: list[RepoInfo], tag: str,
+                         token: str = None) -> dict[str, list[str]]:
+  """
+  Get the workflows to monitor for a given tag in all repos using a single
+  GraphQL query, repos that the query couldn't resolve are looked up using
+  the REST API instead
+  :param repo_configs: list of repo configurations
+  :param tag: string with tag to monitor
+  :param token: github token
+  :return: dictionary mapping repo name to a list of workflow urls
+  """
+  if tag == "" or not repo_configs:
+    return {repo.name: [] for repo in repo_configs}
+
+  # tags created by tag_repo are annotated, the tagger date is used to skip
+  # runs from earlier pushes of the same commit
+  repo_queries = []
+  variables = {'owner': repoinfo.GITHUB_ORGANIZATION, 'ref': f"refs/tags/{tag}"}
+  for i, repo in enumerate(repo_configs):
+    repo_queries.append(f"r{i}: repository(owner: $owner, name: $name{i}) "
+                        "{ ref(qualifiedName: $ref) { target { "
+                        "... on Tag { tagger { date } target { ...runs } } } } }")
+    variables[f"name{i}"] = repo.name
+  declarations = "".join(f", $name{i}: String!" for i in range(len(repo_configs)))
+  query = f"query($owner: String!, $ref: String!{declarations}) {{\n" + \
+          "\n".join(repo_queries) + "\n}\n" \
+          "fragment runs on Commit { checkSuites(first: 100) { " \
+          "pageInfo { hasNextPage } nodes { branch { name } " \
+          "workflowRun { databaseId event createdAt } } } }"
+  data = graphql(query, variables, token)
+
+  workflow_info: dict[str, list[str]] = {}
+  for i, repo in enumerate(repo_configs):
+    repo_data = data.get(f"r{i}")
+    if repo_data is not None and repo_data['ref'] is None:
+      workflow_info[repo.name] = []
+      continue
+    tag_object = repo_data['ref']['target'] if repo_data else {}
+    suites = tag_object.get('target', {}).get('checkSuites')
+    # lightweight tags and commits with more suites than one page are left to REST
+    if not suites or suites['pageInfo']['hasNextPage'] or not tag_object.get('tagger'):
+      workflow_info[repo.name] = get_repo_workflow_by_tag(repo, tag, token)
+      continue
+    tag_date = parse_timestamp(tag_object['tagger']['date'])
+    workflow_info[repo.name] = []
+    for suite in suites['nodes']:
+      run = suite['workflowRun']
+      if run is None or run['event'] != 'push':
+        continue
+      # runs triggered by pushing the tag don't have a branch associated with them
+      if suite['branch'] is not None and suite['branch']['name'] != tag:
+        continue
+      if parse_timestamp(run['createdAt']) < tag_date:
+        continue
+      workflow_info[repo.name].append(repoinfo.generate_repo_url(repo) +
+                                      f"/actions/runs/{run['databaseId']}")
+  return workflow_info
+
+
+@functools.lru_cache(maxsize=8)
+def workflow_time_window(time: datetime.datetime) -> str:
+  """
+  Format the range of creation times used to find workflows started around
+  a given time, the same time is used for every repo so results are cached
+  :param time: approximate time of workflow creation, naive times are in UTC
+  :return: range of times for GitHub's created filter
+  """
+  if time.tzinfo is not None:
+    time = time.astimezone(datetime.timezone.utc)
+  workflow_start = time - datetime.timedelta(minutes=5)
+  workflow_stop = time + datetime.timedelta(minutes=5)
+  return f"{workflow_start:%Y-%m-%dT%H:%M:%SZ}..{workflow_stop:%Y-%m-%dT%H:%M:%SZ}"
+
+
 def get_repo_workflow_by_time(repo_config: RepoInfo, time: datetime.datetime, token: str = None) -> list[str]:
   """
   Get a list of workflows to monitor for a given tag and repo
@@ -172,13 +899,10 @@ def get_repo_workflow_by_time(repo_config: RepoInfo, time: datetime.datetime, to
   :return: list of workflows for a given tag
   """
 
-  workflow_start = time - datetime.timedelta(minutes=5)
-  workflow_stop = time + datetime.timedelta(minutes=5)
   workflow_url = repoinfo.generate_repo_url(repo_config) + \
-                 f"/actions/runs/?created={workflow_start.isoformat()}.." \
-                 f"{workflow_stop.isoformat()}"
+                 f"/actions/runs/?created={workflow_time_window(time)}"
   r = get(workflow_url, token)
-  resp = r.json()
+  resp = response_json(r)
   match r.status_code:
     case 200:
       urls = []
@@ -206,15 +930,16 @@ def get_workflow_status(workflow_url: str, token: str) -> dict[str, str]:
   r = get(workflow_url, token)
   match r.status_code:
     case 200:
-      resp = r.json()
+      resp = response_json(r)
       workflow_info = {'workflow_id': resp['workflow_id'],
                        'status': resp['status'],
+                       'conclusion': resp['conclusion'],
                        'url': resp['html_url']}
       job_resp = get(resp['jobs_url'], token)
       if job_resp.status_code != 200:
         error(f"Can't get job information for workflow {resp['workflow_id']}", abort=False)
         return {}
-      job_json = job_resp.json()
+      job_json = response_json(job_resp)
       workflow_info['job_name'] = job_json["jobs"][-1]["name"]
       workflow_info['job_status'] = job_json["jobs"][-1]["status"]
       return workflow_info
@@ -229,27 +954,78 @@ def get_workflow_status(workflow_url: str, token: str) -> dict[str, str]:
       return {}
 
 
-def workflows_complete(workflow_info: dict[str, list[str]], token: str) -> bool:
+def workflow_url_list(workflow_info: dict[str, list[str]]) -> list[str]:
+  """
+  Flatten workflow information into a list of workflow urls
+  :param workflow_info: dictionary with workflow information
+  :return: list of workflow urls ordered by repo
+  """
+  return [workflow_url for workflows in workflow_info.values() for workflow_url in workflows]
+
+
+def get_workflow_statuses(workflow_urls: list[str], token: str,
+                          finished: dict[str, dict[str, str]] = None) -> list[dict[str, str]]:
+  """
+  Query GitHub for the status of several workflows concurrently
+  :param workflow_urls: list of workflow urls to query
+  :param token: github token
+  :param finished: optional dictionary mapping urls to statuses of workflows
+                   that have finished, these aren't queried again and newly
+                   finished workflows are added to it
+  :return: list of dicts with status of each workflow, in the same order as workflow_urls
+  """
+  if finished is None:
+    finished = {}
+  pending = [url for url in workflow_urls if url not in finished]
+  fetched = dict(zip(pending, _EXECUTOR.map(lambda url: get_workflow_status(url, token), pending)))
+  for url, status in fetched.items():
+    if status and status['conclusion'] in COMPLETED_CONCLUSIONS:
+      finished[url] = status
+  return [finished.get(url) or fetched[url] for url in workflow_urls]
+
+
+# conclusions of workflows that have finished running
+COMPLETED_CONCLUSIONS = frozenset({'success', 'completed', 'cancelled', 'failure',
+                                   'action_required', 'timed_out', 'skipped'})
+
+
+def workflow_done(workflow_url: str, status: dict[str, str]) -> bool:
+  """
+  Check whether a workflow has finished running
+  :param workflow_url: url of the workflow
+  :param status: status of the workflow from get_workflow_status
+  :return: True if the workflow completed
+  """
+  if not status:
+    print(f"workflow: {workflow_url} default not completed")
+    return False
+  return status['conclusion'] in COMPLETED_CONCLUSIONS
+
+
+def workflows_complete(workflow_info: dict[str, list[str]], token: str,
+                       statuses: list[dict[str, str]] = None) -> bool:
   """
   Query GitHub for the status of a given workflow\
   :param workflow_info: dictionary with workflow information
   :param token: github token
+  :param statuses: optional list of workflow statuses already fetched, in the
+                   order given by workflow_url_list(workflow_info)
   :return: True if all workflows completed
   """
-  completed = True
-  for repo, workflows in workflow_info.items():
-    for workflow_url in workflows:
-      r = get(workflow_url, token)
-      match r.status_code:
-        case 200:
-          resp = r.json()
-          if resp['conclusion'] not in ['success', 'completed', 'cancelled', 'failure',
-                                        'action_required', 'timed_out', 'skipped']:
-            completed = False
-        case _:
-          print(f"workflow: {workflow_url} default not completed")
-          completed = False
-  return completed
+  urls = workflow_url_list(workflow_info)
+  if statuses is not None:
+    return all(workflow_done(url, status) for url, status in zip(urls, statuses))
+  # stop at the first workflow that is still running, queries that haven't
+  # started yet are cancelled since their results can't change the answer
+  futures = {_EXECUTOR.submit(get_workflow_status, url, token): url for url in urls}
+  try:
+    for future in concurrent.futures.as_completed(futures):
+      if not workflow_done(futures[future], future.result()):
+        return False
+  finally:
+    for future in futures:
+      future.cancel()
+  return True
 
 
 def create_release_pr(repo: str, base_branch: str, feature_branch: str, release: str, token: str) -> bool:
@@ -7,6 +7,12 @@ from rich.console import Console
 from rich.progress import Progress
 import rich
 
+# pygit2 1.14 moved its constants into pygit2.enums, Pipfile.lock pins an older release
+if hasattr(pygit2, 'GIT_CREDENTIAL_SSH_KEY'):
+  SSH_KEY_CREDENTIAL = pygit2.GIT_CREDENTIAL_SSH_KEY
+else:
+  SSH_KEY_CREDENTIAL = pygit2.enums.CredentialType.SSH_KEY
+
 
 class MyRemoteCallbacks(pygit2.RemoteCallbacks):
 
@@ -21,7 +27,8 @@ class CloneCallbacks(pygit2.RemoteCallbacks):
     :param certificate: tls certificate to use
     :param console: rich console to use for updates
     """
-    super().__init__(credentials=credentials, certificate=certificate)
+    # passed by position since pygit2 1.14 renamed the certificate argument to certificate_check
+    super().__init__(credentials, certificate)
     if console is None:
       self.console = Console()
     else:
@@ -30,6 +37,18 @@ class CloneCallbacks(pygit2.RemoteCallbacks):
     self.transferring = False
     self.transfer_task = None
 
+  def credentials(self, url, username_from_url, allowed_types):
+    """
+    Supply ssh credentials from the running ssh agent when cloning over ssh
+    :param url: url being accessed
+    :param username_from_url: username given in the url, if any
+    :param allowed_types: credential types accepted by the remote
+    :return: credentials to use, None if none are available
+    """
+    if allowed_types & SSH_KEY_CREDENTIAL:
+      return pygit2.KeypairFromAgent(username_from_url or "git")
+    return None
+
   def start_progress(self) -> None:
     """
     Set up a progress bar for cloning progress updates
@@ -86,17 +105,9 @@ def checkout_repo(repo_url: str, repo_dir: str = None,  console: rich.console.Co
   console.print(f"Checking out {repo_url}")
 
   try:
-    os.system(f"git clone {repo_url} {repo_dir}")
-    repo = pygit2.Repository(repo_dir)
-    # print(repo_dir)
-    # clone_callbacks.start_progress()
-    # print(type(clone_callbacks))
-    # print(type(MyRemoteCallbacks()))
-    # repo = pygit2.clone_repository(repo_url, repo_dir, callbacks=clone_callbacks)
-    # repo = pygit2.clone_repository(repo_url, repo_dir, callbacks=MyRemoteCallbacks())
+    clone_callbacks.start_progress()
+    repo = pygit2.clone_repository(repo_url, repo_dir, callbacks=clone_callbacks)
   except Exception as e:
-    # if repo_dir:
-    #   shutil.rmtree(repo_dir)
     print(f"exception {e}")
     return None
   finally:
@@ -108,39 +119,38 @@ def add_file(repo: pygit2.Repository, add_file: str) -> bool:
   """
   Add a file to commit
   :param repo: repo being used
-  :param add_file: path to file being added
+  :param add_file: path to file being added, relative to the repo workdir
   :return: True on success, False otherwise
   """
-  cwd = os.getcwd()
   try:
-    os.chdir(repo.workdir)
-    exit_code = os.system(f"git add {add_file}")
-    return exit_code == 0
-  finally:
-    os.chdir(cwd)
+    repo.index.add(add_file)
+    repo.index.write()
+    return True
+  except (pygit2.GitError, OSError, KeyError):
+    return False
 
 
 def checkout_branch(repo: pygit2.Repository, branch: str) -> bool:
   """
-  Switch to specified branch in given repo
+  Switch to specified branch in given repo, creating a local branch
+  tracking origin if needed
   :param repo: repo being used
   :param branch: name of branch to switch to
   :return: True on success, False otherwise
   """
-  # ref = repo.lookup_branch(branch)
-  # if not ref:
-  #   print("no ref")
-  #   return False
-  # repo.checkout(ref)
-  # return True
-  # checking out the branch doesn't always work so use git directly for now
-  cwd = os.getcwd()
   try:
-    os.chdir(repo.workdir)
-    exit_code = os.system(f"git switch {branch}")
-    return exit_code == 0
-  finally:
-    os.chdir(cwd)
+    local_branch = repo.lookup_branch(branch)
+    if local_branch is None:
+      # a fresh clone only has a local branch for the default branch
+      remote_branch = repo.lookup_branch(f"origin/{branch}", pygit2.GIT_BRANCH_REMOTE)
+      if remote_branch is None:
+        return False
+      local_branch = repo.branches.local.create(branch, remote_branch.peel(pygit2.Commit))
+      local_branch.upstream = remote_branch
+    repo.checkout(local_branch)
+    return True
+  except pygit2.GitError:
+    return False
 
 
 def commit(repo: pygit2.Repository) -> bool:
@@ -1,57 +1,184 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import datetime
+import json
 import os
+import re
 import sys
 import pathlib
 import logging
-import tempfile
 import typing
 import time
 
 import click
 import requests
-import rich
-import rich.align
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from rich.console import Console
+from rich.style import Style
 from rich.text import Text
-from rich.table import Table
-from rich.progress import track
-from rich.logging import RichHandler
-from rich.live import Live
-from rich.layout import Layout
 
+# rich's table, progress and live display modules as well as pygit2 are only
+# needed by some commands and rich's log handler is only used in terminals,
+# they're imported where used to keep startup fast
+if typing.TYPE_CHECKING:
+  from rich.table import Table
 
 import ghlib
-import git
 import repoinfo
 import util
 from error_handling import error, warn
 from repoinfo import RepoInfo
 
+# container registries get their own pooled session so they don't receive
+# GitHub specific headers
+REGISTRY_SESSION = requests.Session()
+# registries that are rate limiting lookups are waited out rather than hit again
+REGISTRY_RETRY = Retry(total=ghlib.MAX_RETRIES, backoff_factor=ghlib.RETRY_BACKOFF,
+                       status_forcelist=[429, 502, 503, 504], allowed_methods={'GET', 'HEAD'},
+                       raise_on_status=False)
+# sized for verify_containers' thread pool so connections aren't discarded
+REGISTRY_SESSION.mount('https://', HTTPAdapter(pool_connections=len(repoinfo.REGISTRY_URLS),
+                                               pool_maxsize=ghlib.MAX_CONCURRENT_REQUESTS,
+                                               max_retries=REGISTRY_RETRY))
+REGISTRY_SESSION.headers.update({'Accept': 'application/json'})
+
+# container images found by earlier runs, published tags aren't removed so
+# each one only needs to be looked up once
+CONTAINER_CACHE_PATH = pathlib.Path("~/.cache/ssl-hep-release-tool/containers.json").expanduser()
+
+# manifest types accepted from registries checked through the OCI distribution API
+OCI_MANIFEST_TYPES = ", ".join(["application/vnd.oci.image.manifest.v1+json",
+                                "application/vnd.oci.image.index.v1+json",
+                                "application/vnd.docker.distribution.manifest.v2+json",
+                                "application/vnd.docker.distribution.manifest.list.v2+json"])
+
+# console shared by all output so terminal capabilities are only detected once
+CONSOLE = Console()
+
+# styles used to show workflow and job states
+STATUS_STYLES = {'success': Style(color="green", bold=True),
+                 'completed': Style(color="green", bold=True),
+                 'cancelled': Style(color="red", blink=True),
+                 'failure': Style(color="red", blink=True),
+                 'action_required': Style(color="red", blink=True),
+                 'timed_out': Style(color="red", blink=True)}
+IN_PROGRESS_STYLE = Style(color="green", dim=True)
+
+# seconds to wait between polls of workflow status
+POLL_INTERVAL_MIN = 5
+POLL_INTERVAL_MAX = 60
+POLL_FAILURE_MAX = 300
+# minutes to wait for workflows to complete
+MONITOR_TIMEOUT = 120
+# seconds to keep looking for workflows of repos that don't have any yet
+WORKFLOW_DISCOVERY_TIME = 120
+
+# prompts are only shown when a user can answer them, in CI the token comes
+# from GITHUB_TOKEN and RELEASE_TOOL_ASSUME_YES=1 answers yes to confirmations
+INTERACTIVE = sys.stdin.isatty() and not os.environ.get('CI')
+ASSUME_YES = os.environ.get('RELEASE_TOOL_ASSUME_YES') == '1'
+# tokens saved with `keyring set ssl-hep-release-tool github` are used before prompting
+KEYRING_SERVICE = "ssl-hep-release-tool"
+
+
+def prompt(message: str) -> str:
+  """
+  Ask the user for input, exits if the tool isn't running interactively
+  :param message: message to show the user
+  :return: str with the user's answer
+  """
+  if not INTERACTIVE:
+    error(f"Can't ask for input when not running interactively: {message}")
+  return input(message)
+
+
+def confirm(message: str) -> bool:
+  """
+  Ask the user a yes/no question, defaults to no when not running
+  interactively unless RELEASE_TOOL_ASSUME_YES is set
+  :param message: question to ask
+  :return: True if the answer is yes
+  """
+  if ASSUME_YES:
+    return True
+  if not INTERACTIVE:
+    warn(f"Not running interactively, answering no to: {message}")
+    return False
+  return input(message).lower().strip() == 'y'
+
+
+def keyring_token() -> str | None:
+  """
+  Look up a GitHub token saved in the system keyring, keyring is optional
+  and is only queried when running interactively since unlocking the
+  keyring may need the user
+  :return: str with GitHub token or None if there isn't one
+  """
+  if not INTERACTIVE:
+    return None
+  try:
+    import keyring
+    import keyring.errors
+  except ImportError:
+    return None
+  try:
+    return keyring.get_password(KEYRING_SERVICE, "github")
+  except keyring.errors.KeyringError:
+    return None
+
 
 def get_token() -> str:
   """
-  Prompt user for GitHub token and do a quick verification
+  Prompt user for GitHub token and do a quick verification, if GitHub App
+  credentials are set in GITHUB_APP_ID, GITHUB_APP_KEY_FILE and
+  GITHUB_APP_INSTALLATION_ID, an installation token is used instead and
+  a token in GITHUB_TOKEN or the keyring is used without prompting
   :return: str with GitHub token
   """
-  token = input("Enter your github token (PAT):")
+  app_id = os.environ.get('GITHUB_APP_ID')
+  key_file = os.environ.get('GITHUB_APP_KEY_FILE')
+  installation_id = os.environ.get('GITHUB_APP_INSTALLATION_ID')
+  if app_id and key_file and installation_id:
+    # installation tokens expire after an hour, ghlib refreshes them as needed
+    token = ghlib.app_installation_token(app_id, pathlib.Path(key_file).read_text(),
+                                         installation_id)
+    if not token:
+      error("Can't get an installation token for the GitHub App")
+    return token
+  token = os.environ.get('GITHUB_TOKEN') or keyring_token() or \
+    prompt("Enter your github token (PAT):")
   if not ghlib.valid_gh_token(token):
     warn("Token seems to be invalid")
-    resp = input("Continue [y/N]? ")
-    if resp.lower().strip() != 'y':
+    if not confirm("Continue [y/N]? "):
       error("Exiting due to missing github PAT")
   return token
 
 
-def generate_tag(repo: RepoInfo) -> str:
+def context_token(ctx: click.Context) -> str:
+  """
+  Get the GitHub token for this invocation, the token is requested and
+  validated once and shared by all commands run in the invocation
+  :param ctx: click.Context with information about invocation
+  :return: str with GitHub token
+  """
+  if 'token' not in ctx.obj:
+    ctx.obj['token'] = get_token()
+  if 'token_valid' not in ctx.obj:
+    ctx.obj['token_valid'] = ghlib.valid_gh_token(ctx.obj['token'])
+  return ctx.obj['token']
+
+
+def generate_tag(repo: RepoInfo, calver: str = None) -> str:
   """
   Given repo information, create a tag for it
   :param repo: repo what will be tagged
+  :param calver: calver to use for calver tags, the current time is used if not given
   :return: a tag for the repo
   """
   match repo.tagtype:
-    case 'calver': return f"{util.generate_calver()}-{repo.label}"
+    case 'calver': return f"{calver or util.generate_calver()}-{repo.label}"
     case 'semver': return f"{repo.semver}-{repo.label}"
   return ""
 
@@ -62,7 +189,8 @@ def get_confirmation(tagged_repos: list[RepoInfo]) -> bool:
   :param tagged_repos: list with repo configs
   :return: true if user confirms, false otherwise
   """
-  console = Console()
+  from rich.table import Table
+
   table = Table(title="Repo tags to be applied")
   table.add_column("Repository")
   table.add_column("URL")
@@ -71,13 +199,8 @@ def get_confirmation(tagged_repos: list[RepoInfo]) -> bool:
     table.add_row(repo.name,
                   Text(repoinfo.generate_repo_url(repo), style=f"link {repoinfo.generate_repo_url(repo)}"),
                   repo.tag)
-  console.print(table)
-  console.print("Apply tags (y/N)? ")
-  resp = input().lower()
-  if resp == 'y':
-    return True
-  else:
-    return False
+  CONSOLE.print(table)
+  return confirm("Apply tags (y/N)? ")
 
 
 def update_branch_config(repo_config: RepoInfo, github_token: str = None) -> bool:
@@ -92,14 +215,11 @@ def update_branch_config(repo_config: RepoInfo, github_token: str = None) -> boo
     error(f"Can't verify branch in {repo_config.name} without a branch being given")
     return False
   branch_url = repoinfo.generate_repo_url(repo_config) + f"/branches/{repo_config.branch}"
-  get_headers = {'Accept': 'application/vnd.github.v3+json'}
-  if github_token:
-    get_headers['Authorization'] = f"token {github_token}"
-  r = requests.get(branch_url, headers=get_headers)
+  r = ghlib.get(branch_url, github_token)
   match r.status_code:
     case 404: return False
     case 200:
-      repo_config.commit = r.json()['commit']['sha']
+      repo_config.commit = ghlib.response_json(r)['commit']['sha']
       return True
     case _: error(f"Got {r.status_code} when accessing github: {branch_url}")
   return False
@@ -125,10 +245,29 @@ def check_repos(repo_configs: list[RepoInfo], github_token: str = None) -> bool:
   :param github_token: GitHub token to use for authentication
   :return: None
   """
+  # look up as many branches as possible with one GraphQL query and fall
+  # back to the REST API for the rest
+  commits = ghlib.get_branch_commits(repo_configs, github_token)
   for repo in repo_configs:
-    if not update_branch_config(repo, github_token):
+    if repo.name not in commits:
+      continue
+    commit = commits[repo.name]
+    if commit is None:
       error(f"Can't find branch {repo.branch} in {repo.name}", abort=False)
       return False
+    repo.commit = commit
+  remaining = [repo for repo in repo_configs if repo.name not in commits]
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=ghlib.MAX_CONCURRENT_REQUESTS)
+  with executor:
+    lookups = {executor.submit(update_branch_config, repo, github_token): repo
+               for repo in remaining}
+    # stop at the first missing branch regardless of which lookup finishes first
+    for lookup in concurrent.futures.as_completed(lookups):
+      if not lookup.result():
+        repo = lookups[lookup]
+        error(f"Can't find branch {repo.branch} in {repo.name}", abort=False)
+        executor.shutdown(wait=False, cancel_futures=True)
+        return False
   return True
 
 
@@ -138,11 +277,11 @@ def generate_repo_tags(repo_configs: list[RepoInfo]) -> list[RepoInfo]:
   :param repo_configs: list of repo configs
   :return: same list with tags defined
   """
-  new_configs = []
+  # every repo gets the same calver even if tagging crosses a minute boundary
+  calver = util.generate_calver()
   for repo in repo_configs:
-    repo.tag = generate_tag(repo)
-    new_configs.append(repo)
-  return new_configs
+    repo.tag = generate_tag(repo, calver)
+  return repo_configs
 
 
 def tag_repos(repo_configs: list[RepoInfo], github_token: str = None) -> str:
@@ -152,16 +291,29 @@ def tag_repos(repo_configs: list[RepoInfo], github_token: str = None) -> str:
   :param github_token: GitHub token for authentication
   :return:  None
   """
-  check_repos(repo_configs, github_token)
-  tagged_configs = generate_repo_tags(repo_configs)
-  if not get_confirmation(tagged_configs):
+  from rich.progress import track
+
+  if not check_repos(repo_configs, github_token):
+    error("Can't verify that all repos and branches exist")
+  generate_repo_tags(repo_configs)
+  if not get_confirmation(repo_configs):
     error("Tagging operation was not confirmed", abort=True)
-  Console().print("Starting tagging operations:")
+  CONSOLE.print("Starting tagging operations:")
   tag = ""
-  for repo in track(tagged_configs, description="Tagging.."):
-    tag = repo.tag
-    if not ghlib.tag_repo(repo, github_token):
-      error(f"Can't tag {repo.name}")
+  failed = []
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=ghlib.MAX_CONCURRENT_WRITES)
+  with executor:
+    # check_repos just took the commits from their branches so they don't need verifying again
+    results = executor.map(lambda repo: ghlib.tag_repo(repo, github_token, verify=False),
+                           repo_configs)
+    for repo, tagged in zip(repo_configs,
+                            track(results, total=len(repo_configs), console=CONSOLE,
+                                  description="Tagging..")):
+      tag = repo.tag
+      if not tagged:
+        failed.append(repo.name)
+  if failed:
+    error(f"Can't tag {', '.join(failed)}")
   return tag
 
 
@@ -169,46 +321,68 @@ def tag_repos(repo_configs: list[RepoInfo], github_token: str = None) -> str:
 @click.option('--tag', type=str, default="", help="Check workflows associated with a tag")
 @click.option("workflow_time", '--time', type=str, default="",
               help="Check for workflows started within 5 minutes of specified time (YYYY-MM-DDTHH:MM:SS)")
+@click.option('--timeout', type=int, default=MONITOR_TIMEOUT,
+              help="Minutes to wait for workflows to complete before giving up")
 @click.pass_obj
 @click.pass_context
-def monitor_workflows(ctx: click.Context, config: dict[str, typing.Any], tag: str, workflow_time: str) -> None:
+def monitor_workflows(ctx: click.Context, config: dict[str, typing.Any], tag: str, workflow_time: str,
+                      timeout: int) -> None:
   """
   Verify that workflows for given tags have completed successfully
   :param ctx: click.Context with information about invocation
   :param config: dictionary with option information
   :param tag: tag to use when finding workflows to monitor
   :param workflow_time: ISO8601 time (YYYY-MM-DDTHH:MM:SS) giving the approximate time for monitored workflows
+  :param timeout: minutes to wait for workflows to complete
   """
-  if 'token' not in ctx.obj:
-    token = get_token()
-    ctx.obj['token'] = token
-  else:
-    token = ctx.obj['token']
-  if not ghlib.valid_gh_token(token):
+  from rich.align import Align
+  from rich.layout import Layout
+  from rich.live import Live
+
+  token = context_token(ctx)
+  if not ctx.obj['token_valid']:
     error("Must provide a valid github token for authentication to get workflow information")
 
-  if workflow_time != "" and not isinstance(workflow_time, datetime.datetime):
+  workflow_datetime = datetime.datetime.now(datetime.timezone.utc)
+  if isinstance(workflow_time, datetime.datetime):
+    workflow_datetime = workflow_time
+  elif workflow_time != "":
+    # times without an offset are taken to be in UTC
     workflow_datetime = datetime.datetime.fromisoformat(workflow_time)
+    if workflow_datetime.tzinfo is None:
+      workflow_datetime = workflow_datetime.replace(tzinfo=datetime.timezone.utc)
   if tag == "" and workflow_time == "":
-    resp = input("Get workflows started around the current time? [Y/n]")
-    if resp.lower().strip() != "y":
+    if not confirm("Get workflows started around the current time? [Y/n]"):
       error("Need a tag or time to monitor workflows")
-    workflow_datetime = datetime.datetime.utcnow()
 
-  workflow_info = {}
-  if tag != "":
-    for repo in config['repo_configs']:
-      workflow_info[repo.name] = ghlib.get_repo_workflow_by_tag(repo, tag, token)
-  elif workflow_time != "":
-    for repo in config['repo_configs']:
-      workflow_info[repo.name] = ghlib.get_repo_workflow_by_time(repo, workflow_datetime, token)
-  console = Console()
-  with Live(console=console, auto_refresh=False) as live_table:
+  repo_configs = config['repo_configs']
+  workflow_info: dict[str, list[str]] = {repo.name: [] for repo in repo_configs}
+  # workflows for freshly tagged repos can take a little while to show up on
+  # GitHub, keep looking for them while polling the workflows already found
+  discovery_deadline = time.monotonic() + WORKFLOW_DISCOVERY_TIME
+  poll_interval = float(POLL_INTERVAL_MIN)
+  failures = 0
+  previous_statuses: list[dict[str, str]] = []
+  # workflows that have finished won't change so they're only queried once
+  finished: dict[str, dict[str, str]] = {}
+  deadline = time.monotonic() + timeout * 60
+  table: Table | None = None
+  with Live(console=CONSOLE, auto_refresh=False) as live_table:
     while True:
-      table = generate_table(workflow_info, token)
-      live_table.update(rich.align.Align.center(table), refresh=True)
-      if ghlib.workflows_complete(workflow_info, token):
-        table = generate_table(workflow_info, token)
+      missing = [repo for repo in repo_configs if not workflow_info.get(repo.name)]
+      if missing and time.monotonic() < discovery_deadline:
+        for name, urls in find_workflows(missing, tag, workflow_datetime, token).items():
+          if urls:
+            workflow_info[name] = urls
+        missing = [repo for repo in missing if not workflow_info.get(repo.name)]
+      searching = bool(missing) and time.monotonic() < discovery_deadline
+      statuses = ghlib.get_workflow_statuses(ghlib.workflow_url_list(workflow_info), token,
+                                             finished)
+      # only rebuild and redraw the table when something changed
+      if table is None or statuses != previous_statuses:
+        table = generate_table(workflow_info, token, statuses)
+        live_table.update(Align.center(table), refresh=True)
+      if not searching and ghlib.workflows_complete(workflow_info, token, statuses):
         live_layout = Layout()
         live_layout.split_column(Layout(name="upper"), Layout(name="lower"))
         live_layout['upper'].ratio = 1
@@ -216,16 +390,65 @@ def monitor_workflows(ctx: click.Context, config: dict[str, typing.Any], tag: st
         live_layout['lower'].update("All workflows completed")
         live_table.update(live_layout, refresh=True)
         return
-      time.sleep(30)
+      if {} in statuses:
+        failures += 1
+      else:
+        failures = 0
+      poll_interval = next_poll_interval(poll_interval, statuses != previous_statuses, failures)
+      previous_statuses = statuses
+      if time.monotonic() + poll_interval > deadline:
+        error(f"Workflows didn't complete within {timeout} minutes")
+      time.sleep(poll_interval)
+
+
+def find_workflows(repo_configs: list[RepoInfo], tag: str, workflow_datetime: datetime.datetime,
+                   token: str) -> dict[str, list[str]]:
+  """
+  Find the workflows to monitor for a set of repos
+  :param repo_configs: list of repo configs
+  :param tag: tag to find workflows for, if empty workflow_datetime is used
+  :param workflow_datetime: approximate start time of the workflows
+  :param token: GitHub token
+  :return: dictionary mapping repo names to lists of workflow urls
+  """
+  if tag != "":
+    return ghlib.get_workflows_by_tag(repo_configs, tag, token)
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=ghlib.MAX_CONCURRENT_REQUESTS)
+  with executor:
+    lookups = [executor.submit(ghlib.get_repo_workflow_by_time, repo, workflow_datetime, token)
+               for repo in repo_configs]
+    return {repo.name: lookup.result() for repo, lookup in zip(repo_configs, lookups)}
+
+
+def next_poll_interval(interval: float, changed: bool, failures: int) -> float:
+  """
+  Work out how long to wait before polling workflows again, polls quickly
+  while workflows are changing and backs off when nothing changes or when
+  GitHub queries fail
+  :param interval: current polling interval in seconds
+  :param changed: True if any workflow status changed since the last poll
+  :param failures: number of consecutive polls with failed queries
+  :return: new polling interval in seconds
+  """
+  if failures:
+    return min(POLL_FAILURE_MAX, POLL_INTERVAL_MIN * 2 ** failures)
+  if changed:
+    return POLL_INTERVAL_MIN
+  return min(POLL_INTERVAL_MAX, interval * 1.5)
 
 
-def generate_table(workflow_info: dict[str, list[str]], token: str) -> rich.table.Table:
+def generate_table(workflow_info: dict[str, list[str]], token: str,
+                   statuses: list[dict[str, str]] = None) -> "Table":
   """
   Generate a rich table with workflow information
   :param workflow_info: dictionary with workflow information
   :param token: GitHub token
+  :param statuses: optional list of workflow statuses already fetched, in the
+                   order given by ghlib.workflow_url_list(workflow_info)
   :return: a rich table with workflow information
   """
+  from rich.table import Table
+
   table = Table(title="Workflow Status")
   table.add_column("Repo")
   table.add_column("Workflow")
@@ -233,32 +456,24 @@ def generate_table(workflow_info: dict[str, list[str]], token: str) -> rich.tabl
   table.add_column("Workflow Status")
   table.add_column("Current Job")
   table.add_column("Job Status")
-  for repo, workflows in workflow_info.items():
-    for workflow_url in workflows:
-      status = ghlib.get_workflow_status(workflow_url, token)
-      if status == {}:
-        table.add_row(repo, None, None, None, None)
-        continue
-      if status['status'] in ['success', 'completed']:
-        status_text = Text(status['status'], style="bold green")
-      elif status['status'] in ['cancelled', 'failure', 'action_required', 'timed_out']:
-        status_text = Text(status['status'], style="blink red")
-      else:
-        status_text = Text(status['status'], style="dim green")
-      if status['job_status'] in ['success', 'completed']:
-        job_text = Text(status['status'], style="bold green")
-      elif status['job_status'] in ['cancelled', 'failure', 'action_required', 'timed_out']:
-        job_text = Text(status['job_status'], style="blink red")
-      else:
-        job_text = Text(status['job_status'], style="dim green")
-
-      status_url = Text(status['url'], style=f"link {status['url']} blue")
-      table.add_row(repo,
-                    f"{status['workflow_id']}",
-                    status_url,
-                    status_text,
-                    status['job_name'],
-                    job_text)
+  if statuses is None:
+    statuses = ghlib.get_workflow_statuses(ghlib.workflow_url_list(workflow_info), token)
+  repos = [repo for repo, urls in workflow_info.items() for _ in urls]
+  for repo, status in zip(repos, statuses):
+    if status == {}:
+      table.add_row(repo, None, None, None, None)
+      continue
+    status_text = Text(status['status'], style=STATUS_STYLES.get(status['status'],
+                                                                 IN_PROGRESS_STYLE))
+    job_text = Text(status['job_status'], style=STATUS_STYLES.get(status['job_status'],
+                                                                  IN_PROGRESS_STYLE))
+    status_url = Text(status['url'], style=Style(color="blue", link=status['url']))
+    table.add_row(repo,
+                  f"{status['workflow_id']}",
+                  status_url,
+                  status_text,
+                  status['job_name'],
+                  job_text)
   return table
 
 
@@ -276,74 +491,167 @@ def tag(ctx: click.Context, config: dict[str, typing.Any], verify: bool, publish
   :param publish: bool indicating whether to publish chart
   :return:
   """
-  if 'token' not in ctx.obj:
-    token = get_token()
-    ctx.obj['token'] = token
-  else:
-    token = ctx.obj['token']
+  token = context_token(ctx)
   repo_configs = config['repo_configs']
-  if not check_repos(repo_configs, token):
-    error("Can't verify that all repos and branches exist")
+  # ask everything before tagging so that nobody has to wait at the terminal
+  # while workflows are monitored
+  if not verify:
+    verify = confirm("Verify container creation? [y/N]")
+  chart_version = ""
+  if publish and verify:
+    chart_version = prompt("Chart version to publish? ")
+    if not confirm(f"Publish chart {chart_version} [y/N]? "):
+      CONSOLE.print("Chart won't be published")
+      publish = False
   tag = tag_repos(repo_configs, token)
   if not verify:
-    user = input("Verify container creation? [y/N]")
-    if user.lower().strip() != 'y':
-      sys.exit(0)
-  workflow_time = datetime.datetime.utcnow()
+    sys.exit(0)
+  workflow_time = datetime.datetime.now(datetime.timezone.utc)
 
   ctx.obj['config'] = repo_configs
   ctx.invoke(monitor_workflows, tag=tag, workflow_time=workflow_time)
   ctx.obj['config'] = config
   ctx.invoke(verify_containers, tag=tag)
   if publish:
-    chart_version = input("Chart version to publish? ")
-    user = input(f"Publish chart {chart_version} [y/N]? ")
-    if user.lower().strip() != 'y':
-      Console().print("Exiting since no chart version given")
-      sys.exit(0)
     ctx.invoke(release, tag=tag, chart_version=chart_version)
-    Console().print("Release tagged and published")
+    CONSOLE.print("Release tagged and published")
   else:
-    Console().print("Release tagged")
+    CONSOLE.print("Release tagged")
   sys.exit(0)
 
 
 @click.command(help="Verify containers have been published at sources given in config file")
 @click.option("--tag", type=str, default="", required=True, prompt=True)
+@click.option("--registry", type=str, default="",
+              help="Registry host to check instead of the ones in the config file, e.g. a mirror")
 @click.pass_obj
-def verify_containers(config: dict[str, typing.Any], tag: str) -> None:
+def verify_containers(config: dict[str, typing.Any], tag: str, registry: str) -> None:
   """
   Tag repos
   :param config: dictionary with configuration parameters
   :param tag: container tag to check
+  :param registry: registry to check instead of the ones given for each repo
   :return: None
   """
+  from rich.progress import track
+
   if tag == "":
     error("Must specify a valid tag")
 
   repo_configs = config['repo_configs']
-  console = Console()
-  console.print("\nChecking for docker containers:")
-  registry_repos = [repo for repo in repo_configs if repo.container_registry != ""]
-  for repo in track(registry_repos, description="Checking.."):
-    if not find_container(repo, tag):
-      print(dir(repo))
-      error(f"Can't find container in {repo.container_repo} tagged as {tag} for {repo.name}")
-  console.print("All containers verified successfully")
+  use_cache = config.get('use_cache', True)
+  found_containers = load_found_containers() if use_cache else set()
+  CONSOLE.print("\nChecking for docker containers:")
+  # repos publishing to the same image only need it looked up once
+  registry_repos: dict[str, list[RepoInfo]] = {}
+  for repo in repo_configs:
+    if repo.container_registry == "":
+      continue
+    url = repoinfo.container_url(repo, tag, registry)
+    if url not in found_containers:
+      registry_repos.setdefault(url, []).append(repo)
+  try:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=ghlib.MAX_CONCURRENT_REQUESTS)
+    with executor:
+      results = executor.map(lambda repos: find_container(repos[0], tag, registry),
+                             registry_repos.values())
+      for (url, repos), found in zip(registry_repos.items(),
+                                     track(results, total=len(registry_repos),
+                                           description="Checking..", console=CONSOLE)):
+        if not found:
+          executor.shutdown(wait=False, cancel_futures=True)
+          names = ", ".join(repo.name for repo in repos)
+          error(f"Can't find container in {repos[0].container_repo} tagged as {tag} for {names}")
+        found_containers.add(url)
+  finally:
+    # containers found before a failure don't need to be checked again either
+    if use_cache:
+      save_found_containers(found_containers)
+  CONSOLE.print("All containers verified successfully")
+
+
+def load_found_containers() -> set[str]:
+  """
+  Load the urls of container images found by earlier runs
+  :return: set of container urls
+  """
+  try:
+    return set(json.loads(CONTAINER_CACHE_PATH.read_text()))
+  except (OSError, ValueError):
+    return set()
 
 
-def find_container(repo: RepoInfo, tag) -> bool:
+def save_found_containers(found_containers: set[str]) -> None:
+  """
+  Save the urls of container images that have been found so later runs can
+  skip looking them up
+  :param found_containers: set of container urls
+  :return: None
+  """
+  try:
+    CONTAINER_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so concurrent runs never read a partial file
+    temp_path = CONTAINER_CACHE_PATH.with_name(f"{CONTAINER_CACHE_PATH.name}.{os.getpid()}")
+    temp_path.write_text(json.dumps(sorted(found_containers)))
+    temp_path.replace(CONTAINER_CACHE_PATH)
+  except OSError as e:
+    warn(f"Can't save container cache: {e}")
+
+
+def find_container(repo: RepoInfo, tag, registry: str = None) -> bool:
   """
   Check for containers
   :param repo: RepoInfo object with information for repo
   :param tag: tag for container image
+  :param registry: registry to check instead of the one given for the repo
   :return: True if container found, false otherwise
   """
-  container_url = repoinfo.container_url(repo, tag)
-  r = requests.get(container_url)
-  if r.status_code == 200:
-    return True
-  return False
+  container_url = repoinfo.container_url(repo, tag, registry)
+  headers = {}
+  if (registry or repo.container_registry) not in repoinfo.REGISTRY_URLS:
+    headers['Accept'] = OCI_MANIFEST_TYPES
+  # only the status is needed so skip downloading the tag's details
+  r = REGISTRY_SESSION.head(container_url, headers=headers, timeout=ghlib.REQUEST_TIMEOUT,
+                            allow_redirects=True)
+  if r.status_code == 401:
+    # registries that allow anonymous pulls still want a token for them
+    token = registry_token(r.headers.get('Www-Authenticate', ""))
+    if token:
+      headers['Authorization'] = f"Bearer {token}"
+      r = REGISTRY_SESSION.head(container_url, headers=headers, timeout=ghlib.REQUEST_TIMEOUT,
+                                allow_redirects=True)
+  if r.status_code == 405:
+    r = REGISTRY_SESSION.get(container_url, headers=headers, timeout=ghlib.REQUEST_TIMEOUT)
+  match r.status_code:
+    case 200:
+      return True
+    case 404:
+      return False
+    case _:
+      error(f"Got {r.status_code} when checking {container_url}", abort=False)
+      return False
+
+
+def registry_token(challenge: str) -> str:
+  """
+  Get an anonymous bearer token from a registry's token service
+  :param challenge: Www-Authenticate header from the registry's 401 reply
+  :return: token, empty if one can't be obtained
+  """
+  if not challenge.lower().startswith("bearer "):
+    return ""
+  params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+  realm = params.pop('realm', "")
+  if not realm:
+    return ""
+  r = REGISTRY_SESSION.get(realm, params=params, timeout=ghlib.REQUEST_TIMEOUT)
+  if r.status_code != 200:
+    return ""
+  try:
+    body = r.json()
+  except ValueError:
+    return ""
+  return body.get('token') or body.get('access_token', "")
 
 
 @click.command(help="Generate and publish chart")
@@ -362,12 +670,12 @@ def release(ctx: click.Context, config: dict[str, typing.Any], tag: str, chart_v
   :param verify: bool indicating whether to verify generation of containers
   :return: None
   """
-  if 'token' not in ctx.obj:
-    token = get_token()
-    ctx.obj['token'] = token
-  else:
-    token = ctx.obj['token']
-  if not ghlib.valid_gh_token(token):
+  import tempfile
+
+  import git
+
+  context_token(ctx)
+  if not ctx.obj['token_valid']:
     error("Must provide a valid github token for authentication to get workflow information")
   if verify:
     ctx.obj['config'] = config
@@ -383,8 +691,8 @@ def release(ctx: click.Context, config: dict[str, typing.Any], tag: str, chart_v
     orig_dir = os.getcwd()
     os.chdir(temp_dir)
     print(f"Checking out in {temp_dir}")
-    console = Console()
-    servicex_repo = git.checkout_repo("ssh://git@github.com/ssl-hep/ServiceX.git", f"{temp_dir}/ServiceX", console)
+    servicex_repo = git.checkout_repo("ssh://git@github.com/ssl-hep/ServiceX.git",
+                                      f"{temp_dir}/ServiceX", CONSOLE)
     if servicex_repo is None:
       error("Can't checkout ServiceX repo")
     else:
@@ -396,7 +704,8 @@ def release(ctx: click.Context, config: dict[str, typing.Any], tag: str, chart_v
     git.add_file(servicex_repo, "servicex/Chart.yaml")
     git.add_file(servicex_repo, "servicex/values.yaml")
     git.commit(servicex_repo)
-    chart_repo = git.checkout_repo("ssh://git@github.com/ssl-hep/ssl-helm-charts.git", f"{temp_dir}/ssl-helm-charts", console)
+    chart_repo = git.checkout_repo("ssh://git@github.com/ssl-hep/ssl-helm-charts.git",
+                                   f"{temp_dir}/ssl-helm-charts", CONSOLE)
     if chart_repo is None:
       error("Can't checkout ssl-helm-charts repo")
     else:
@@ -422,7 +731,8 @@ def release(ctx: click.Context, config: dict[str, typing.Any], tag: str, chart_v
 
 def setup_logging(debug: bool) -> None:
   """
-  Setup logging with rich
+  Setup logging with rich when output goes to a terminal and plain log
+  lines otherwise, e.g. in CI
 
   :return: None
   """
@@ -430,12 +740,21 @@ def setup_logging(debug: bool) -> None:
     log_level = "DEBUG"
   else:
     log_level = "INFO"
-  logging.basicConfig(
-    level=log_level,
-    format="%(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler(rich_tracebacks=True)]
-  )
+  if CONSOLE.is_terminal:
+    from rich.logging import RichHandler
+
+    logging.basicConfig(
+      level=log_level,
+      format="%(message)s",
+      datefmt="[%X]",
+      handlers=[RichHandler(console=CONSOLE, rich_tracebacks=True)]
+    )
+  else:
+    logging.basicConfig(
+      level=log_level,
+      format="%(asctime)s %(levelname)s %(message)s",
+      datefmt="%X"
+    )
 
 
 def get_config(config: str) -> list[RepoInfo]:
@@ -451,17 +770,21 @@ def get_config(config: str) -> list[RepoInfo]:
 @click.group()
 @click.option("--config", default="repos.toml", type=str, help="Configuration file for toml", required=True)
 @click.option("--debug", default=False, type=bool, help="Enable debugging")
+@click.option("--no-cache", "no_cache", is_flag=True, default=False,
+              help="Don't reuse GitHub responses or container lookups cached by earlier runs")
 @click.pass_context
-def entry(ctx: click.Context, config: str, debug: bool) -> None:
+def entry(ctx: click.Context, config: str, debug: bool, no_cache: bool) -> None:
   """
   Do various release tasks for ServiceX
   """
   setup_logging(debug)
+  if not no_cache:
+    ghlib.enable_disk_cache()
   repo_configs = get_config(config)
-  token = get_token()
   ctx.obj = {'config': config,
              'repo_configs': repo_configs,
-             'token': token}
+             'use_cache': not no_cache}
+  context_token(ctx)
 
 
 entry.add_command(tag)
@@ -1,12 +1,17 @@
 # RepoInfo class used in various scripts
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 GITHUB_BASE_URL = "https://api.github.com"
 GITHUB_ORGANIZATION = "ssl-hep"
+REPO_URL_PREFIX = f"{GITHUB_BASE_URL}/repos/{GITHUB_ORGANIZATION}/"
 
+# base urls of the container repositories in each supported registry
+REGISTRY_URLS = {'dockerhub': "https://hub.docker.com/v2/repositories/",
+                 'harbor': "https://hub.opensciencegrid.org/sslhep/"}
 
-@dataclass
+
+@dataclass(slots=True)
 class RepoInfo:
   name: str
   branch: str
@@ -18,6 +23,11 @@ class RepoInfo:
   newtag: str = ""
   container_repo: str = ""
   container_registry: str = ""
+  # GitHub API url for the repo, built once since every request for the repo uses it
+  repo_url: str = field(init=False, repr=False, compare=False, default="")
+
+  def __post_init__(self) -> None:
+    self.repo_url = REPO_URL_PREFIX + self.name
 
 
 def generate_repo_url(repo_config: RepoInfo) -> str:
@@ -26,20 +36,23 @@ def generate_repo_url(repo_config: RepoInfo) -> str:
   :param repo_config: information for repo
   :return: url for the repo string
   """
-  return f"{GITHUB_BASE_URL}/repos/{GITHUB_ORGANIZATION}/{repo_config.name}"
+  return repo_config.repo_url
 
 
-def container_url(repo_config: RepoInfo, tag) -> str:
+def container_url(repo_config: RepoInfo, tag, registry: str = None) -> str:
   """
-  Using repo_config get url for container image location
+  Using repo_config get url for container image location, registries other
+  than the ones in REGISTRY_URLS are treated as hosts serving the OCI
+  distribution API
   :param repo_config: information for repo
   :param tag: string with tag for the container
+  :param registry: registry to use instead of the one given for the repo
   :return: url for the repo string
   """
-  match repo_config.container_registry:
-    case "dockerhub":
-      return  f'https://hub.docker.com/v2/repositories/{repo_config.container_repo}/tags/{tag}'
-    case "harbor":
-      return f'https://hub.opensciencegrid.org/sslhep/{repo_config.container_repo}/tags/{tag}'
-    case _:
-      return ""
+  registry = registry or repo_config.container_registry
+  if not registry:
+    return ""
+  registry_url = REGISTRY_URLS.get(registry)
+  if registry_url is None:
+    return f"https://{registry}/v2/{repo_config.container_repo}/manifests/{tag}"
+  return f"{registry_url}{repo_config.container_repo}/tags/{tag}"
@@ -1,6 +1,24 @@
+import collections
+import concurrent.futures
+import datetime
+import json
 import pathlib
+import socket
+import subprocess
+import sys
 import time
+import types
 
+import click.testing
+import pygit2
+import pytest
+import requests
+import rich.console
+import urllib3
+import yaml
+
+import ghlib
+import git
 import release_tool
 import repoinfo
 import util
@@ -9,6 +27,28 @@ VALID_TEST_FILE = "tests/test-tag.toml"
 INVALID_TEST_FILE = "tests/invalid-tag.toml"
 
 
+@pytest.fixture(autouse=True)
+def config_cache_dir(monkeypatch, tmp_path):
+    """
+    Keep parsed configurations cached by tests out of the user's cache directory
+    :return: path to the cache directory used
+    """
+    cache_dir = tmp_path / "config-cache"
+    monkeypatch.setattr(util, "CONFIG_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+@pytest.fixture(autouse=True)
+def container_cache_path(monkeypatch, tmp_path):
+    """
+    Keep container lookups cached by tests out of the user's cache directory
+    :return: path to the cache file used
+    """
+    cache_path = tmp_path / "containers.json"
+    monkeypatch.setattr(release_tool, "CONTAINER_CACHE_PATH", cache_path)
+    return cache_path
+
+
 class TestTagRelease:
     """
     Class to test release_tool.py code
@@ -26,6 +66,23 @@ class TestTagRelease:
         config = release_tool.ingest_config(pathlib.Path(VALID_TEST_FILE))
         assert(config == expected_config)
 
+    def test_ingest_config_errors(self, tmp_path, caplog):
+        """
+        Test that every problem in a configuration is reported before exiting
+        :return: None
+        """
+        config_file = tmp_path / "repos.toml"
+        config_file.write_text('[test1]\nbranch = "develop"\nlabel = "develop1"\n'
+                               '[test2]\nbranch = "develop"\nlabel = "develop1"\n'
+                               'tagtype = "other"\n'
+                               '[test3]\nbranch = "master"\nlabel = "stable"\n'
+                               'tagtype = "semver"\n')
+        with pytest.raises(SystemExit):
+            util.ingest_config(config_file)
+        assert "Section test1 missing tagtype setting" in caplog.text
+        assert "In section test2, tagtype must be 'semver' or 'calver', got other" in caplog.text
+        assert "Section test3 missing semver setting" in caplog.text
+
     def test_generate_repo_url(self):
         """
         Test generate repo url code
@@ -45,6 +102,109 @@ class TestTagRelease:
         test_time = time.strptime("2022-02-16 09:18", "%Y-%m-%d %H:%M")
         assert(util.generate_calver(test_time) == "20220216-0918")
 
+    def test_replace_tags(self, tmp_path):
+        """
+        Test that image tags in a values.yaml file are replaced
+        :return: None
+        """
+        values_file = tmp_path / "values.yaml"
+        values_file.write_text("app:\n  tag: develop\n  image: servicex_app\n"
+                               "transformer:\n  defaultTransformerTag: develop\n")
+        util.replace_tags(values_file, "1.2.3")
+        values = yaml.safe_load(values_file.read_text())
+        assert values == {'app': {'tag': "1.2.3", 'image': "servicex_app"},
+                          'transformer': {'defaultTransformerTag': "1.2.3"}}
+        assert not (tmp_path / "values.yaml.new").exists()
+
+    def test_replace_tags_formatting(self, tmp_path):
+        """
+        Test that replacing tags leaves comments and other values untouched
+        :return: None
+        """
+        values_file = tmp_path / "values.yaml"
+        values_file.write_text("# ServiceX settings\n"
+                               "app:\n"
+                               "  image: servicex_app  # app image\n"
+                               "  tag: develop  # updated on release\n"
+                               "  ingress:\n"
+                               "    tag: keep\n"
+                               "codeGen:\n"
+                               "  enabled: true\n")
+        util.replace_tags(values_file, "1.2")
+        assert values_file.read_text() == ("# ServiceX settings\n"
+                                           "app:\n"
+                                           "  image: servicex_app  # app image\n"
+                                           "  tag: '1.2'  # updated on release\n"
+                                           "  ingress:\n"
+                                           "    tag: keep\n"
+                                           "codeGen:\n"
+                                           "  enabled: true\n")
+
+        chart_file = tmp_path / "Chart.yaml"
+        chart_file.write_text("apiVersion: v2\nversion: 1.0.0\nappVersion: develop\n")
+        util.replace_appver(chart_file, "1.2.3", "1.2.3")
+        assert chart_file.read_text() == "apiVersion: v2\nversion: 1.2.3\nappVersion: 1.2.3\n"
+
+    def test_replace_tags_fallback(self, tmp_path):
+        """
+        Test that values the line edit can't handle are still replaced
+        :return: None
+        """
+        values_file = tmp_path / "values.yaml"
+        values_file.write_text("app: {tag: develop, image: servicex_app}\n")
+        util.replace_tags(values_file, "1.2.3")
+        values = yaml.safe_load(values_file.read_text())
+        assert values == {'app': {'tag': "1.2.3", 'image': "servicex_app"}}
+
+    def test_generate_helm_package(self, monkeypatch, tmp_path):
+        """
+        Test that helm runs in the chart directories without changing the working directory
+        :return: None
+        """
+        chart_dir = tmp_path / "charts"
+        chart_repo_dir = tmp_path / "repo"
+        chart_dir.mkdir()
+        chart_repo_dir.mkdir()
+        calls = []
+
+        def fake_run(args, cwd):
+            calls.append((args[:2], cwd))
+            if args[:2] == ["helm", "package"]:
+                (cwd / "servicex-1.2.3.tgz").write_text("chart")
+            return subprocess.CompletedProcess(args, 0)
+
+        monkeypatch.setattr(util.subprocess, "run", fake_run)
+        cwd = pathlib.Path.cwd()
+        util.generate_helm_package(chart_dir, chart_repo_dir)
+        assert pathlib.Path.cwd() == cwd
+        assert calls == [(["helm", "dependency"], chart_dir), (["helm", "package"], chart_dir),
+                         (["helm", "repo"], chart_repo_dir)]
+        assert (chart_repo_dir / "servicex-1.2.3.tgz").is_file()
+        assert not (chart_dir / "servicex-1.2.3.tgz").exists()
+
+        # a missing helm is reported instead of raising
+        def missing_helm(args, cwd):
+            raise FileNotFoundError(2, "No such file or directory", "helm")
+
+        monkeypatch.setattr(util.subprocess, "run", missing_helm)
+        with pytest.raises(SystemExit):
+            util.generate_helm_package(chart_dir, chart_repo_dir)
+
+    def test_checkout_branch(self, tmp_path):
+        """
+        Test switching a fresh clone to a branch that only exists on origin
+        :return: None
+        """
+        origin = pygit2.init_repository(str(tmp_path / "origin"))
+        signature = pygit2.Signature("test", "test@example.org")
+        tree = origin.index.write_tree()
+        head = origin.create_commit("HEAD", signature, signature, "initial", tree, [])
+        origin.branches.local.create("gh-pages", origin[head])
+        clone = pygit2.clone_repository(str(tmp_path / "origin"), str(tmp_path / "clone"))
+        assert git.checkout_branch(clone, "gh-pages")
+        assert clone.head.shorthand == "gh-pages"
+        assert not git.checkout_branch(clone, "missing")
+
     def test_generate_tag(self):
         """
         Test tag generation
@@ -56,6 +216,7 @@ class TestTagRelease:
 
         assert(release_tool.generate_tag(config[0]) == f"{calver}-develop1")
         assert (release_tool.generate_tag(config[1]) == "1.2.4rc2-release1")
+        assert release_tool.generate_tag(config[0], "20220216-0918") == "20220216-0918-develop1"
 
     def test_update_branch_config(self):
         """
@@ -73,6 +234,17 @@ class TestTagRelease:
         assert(release_tool.update_branch_config(config[1]))
         assert(config[1].commit == "8762caebb3b92955e6583b2eef5f7aaf4b277c57")
 
+    def test_next_poll_interval(self):
+        """
+        Test adaptive polling interval for workflow monitoring
+        :return: None
+        """
+        assert release_tool.next_poll_interval(30, True, 0) == release_tool.POLL_INTERVAL_MIN
+        assert release_tool.next_poll_interval(10, False, 0) == 15
+        assert release_tool.next_poll_interval(50, False, 0) == release_tool.POLL_INTERVAL_MAX
+        assert release_tool.next_poll_interval(5, True, 2) == 4 * release_tool.POLL_INTERVAL_MIN
+        assert release_tool.next_poll_interval(5, False, 10) == release_tool.POLL_FAILURE_MAX
+
     def test_verify_commit(self):
         """
         Test functionality to verify that a commit exists within the repo
@@ -93,3 +265,813 @@ class TestTagRelease:
         assert(release_tool.check_repos(config))
         config = release_tool.ingest_config(pathlib.Path(INVALID_TEST_FILE))
         assert (not release_tool.check_repos(config))
+
+
+def make_response(status_code: int, body: dict = None, headers: dict = None) -> requests.Response:
+    """
+    Create a response like those returned by the GitHub API
+    :param status_code: HTTP status code of response
+    :param body: dictionary with JSON body of response
+    :param headers: dictionary with response headers
+    :return: requests.Response
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body or {}).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+class TestGhlib:
+    """
+    Class to test ghlib.py code using mocked GitHub responses
+    """
+
+    def test_retry_request_get(self, monkeypatch):
+        """
+        Test that GET requests are retried after connection errors
+        :return: None
+        """
+        responses = [requests.exceptions.ConnectionError("dropped"), make_response(200)]
+        calls = []
+        timeouts = []
+
+        def fake_request(method, url, **kwargs):
+            calls.append(method)
+            timeouts.append(kwargs['timeout'])
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        waits = []
+        monkeypatch.setattr(ghlib.SESSION, "request", fake_request)
+        monkeypatch.setattr(ghlib.time, "sleep", waits.append)
+        assert ghlib.request('GET', "https://api.github.com/").status_code == 200
+        assert calls == ['GET', 'GET']
+        assert timeouts == [ghlib.REQUEST_TIMEOUT] * 2
+        assert ghlib.RETRY_BACKOFF / 2 <= waits[-1] <= ghlib.RETRY_BACKOFF
+
+    def test_retry_request_post(self, monkeypatch):
+        """
+        Test that POST requests aren't resent if the connection dropped after
+        the request may have been sent, but are if the connection failed
+        :return: None
+        """
+        calls = []
+
+        def dropped_request(method, url, **kwargs):
+            calls.append(method)
+            raise requests.exceptions.ConnectionError("dropped")
+
+        monkeypatch.setattr(ghlib.SESSION, "request", dropped_request)
+        monkeypatch.setattr(ghlib.time, "sleep", lambda seconds: None)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            ghlib.post("https://api.github.com/repos/ssl-hep/test1/git/tags", {}, "token")
+        assert calls == ['POST']
+
+        responses = [requests.exceptions.ConnectTimeout("timeout"), make_response(201)]
+        calls.clear()
+
+        def connect_failure(method, url, **kwargs):
+            calls.append(method)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        monkeypatch.setattr(ghlib.SESSION, "request", connect_failure)
+        assert ghlib.post("https://api.github.com/repos/ssl-hep/test1/git/tags",
+                          {}, "token").status_code == 201
+        assert calls == ['POST', 'POST']
+
+    def test_retry_request_dns(self, monkeypatch):
+        """
+        Test that requests aren't retried when the server's name can't be resolved
+        :return: None
+        """
+        try:
+            try:
+                raise socket.gaierror(-2, "Name or service not known")
+            except socket.gaierror as err:
+                raise urllib3.exceptions.NewConnectionError(None, "Failed to resolve") from err
+        except urllib3.exceptions.NewConnectionError as err:
+            reason = err
+        calls = []
+
+        def unresolved_request(method, url, **kwargs):
+            calls.append(method)
+            raise requests.exceptions.ConnectionError(
+                urllib3.exceptions.MaxRetryError(None, url, reason))
+
+        waits = []
+        monkeypatch.setattr(ghlib.SESSION, "request", unresolved_request)
+        monkeypatch.setattr(ghlib.time, "sleep", waits.append)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            ghlib.request('GET', "https://api.github.com/")
+        assert calls == ['GET']
+        assert waits == []
+        assert not ghlib.name_resolution_failed(requests.exceptions.ConnectionError("dropped"))
+
+    def test_rate_limit_wait(self, monkeypatch):
+        """
+        Test detection of primary and secondary rate limits
+        :return: None
+        """
+        monkeypatch.setattr(ghlib.time, "time", lambda: 1000.0)
+        assert ghlib.rate_limit_wait(make_response(200)) == 0
+        assert ghlib.rate_limit_wait(make_response(403, {'message': "Forbidden"})) == 0
+        assert ghlib.rate_limit_wait(make_response(403, headers={'Retry-After': "30"})) == 30
+        assert ghlib.rate_limit_wait(
+            make_response(403, headers={'Retry-After': "Thu, 01 Jan 1970 00:17:00 GMT"})) == 20
+        assert ghlib.rate_limit_wait(
+            make_response(403, headers={'X-RateLimit-Remaining': "0",
+                                        'X-RateLimit-Reset': "1010"})) == 11
+        secondary = make_response(403, {'message': "You have exceeded a secondary rate limit"},
+                                  {'X-RateLimit-Remaining': "4000"})
+        assert ghlib.rate_limit_wait(secondary) == ghlib.SECONDARY_RATE_LIMIT_WAIT
+        assert ghlib.rate_limit_wait(secondary, 2) == 4 * ghlib.SECONDARY_RATE_LIMIT_WAIT
+
+    def test_retry_rate_limit(self, monkeypatch):
+        """
+        Test that requests hitting a secondary rate limit are retried
+        :return: None
+        """
+        responses = [make_response(403, {'message': "You have exceeded a secondary rate limit"}),
+                     make_response(200)]
+        waits = []
+        monkeypatch.setattr(ghlib.SESSION, "request", lambda method, url, **kwargs: responses.pop(0))
+        monkeypatch.setattr(ghlib.time, "sleep", waits.append)
+        assert ghlib.request('GET', "https://api.github.com/").status_code == 200
+        assert waits == [ghlib.SECONDARY_RATE_LIMIT_WAIT]
+
+    def test_tag_repo(self, monkeypatch):
+        """
+        Test that tagging a repo creates the tag object and then a ref for it
+        :return: None
+        """
+        calls = []
+
+        def fake_request(method, url, **kwargs):
+            assert kwargs['headers']['Content-Type'] == "application/json"
+            calls.append((method, url, json.loads(kwargs['data'])))
+            if url.endswith("/git/tags"):
+                return make_response(201, {'sha': "tagsha"})
+            return make_response(201)
+
+        monkeypatch.setattr(ghlib, "verify_commit", lambda url, commit, token: True)
+        monkeypatch.setattr(ghlib.SESSION, "request", fake_request)
+        repo = repoinfo.RepoInfo("test1", "develop", "develop1", "calver",
+                                 tag="20220216-0918-develop1", commit="abc123")
+        assert ghlib.tag_repo(repo, "token")
+        assert [url for _, url, _ in calls] == \
+            ["https://api.github.com/repos/ssl-hep/test1/git/tags",
+             "https://api.github.com/repos/ssl-hep/test1/git/refs"]
+        assert calls[0][2] == {'tag': "20220216-0918-develop1",
+                               'message': "Tagged using release_tool.py",
+                               'object': "abc123", 'type': "commit"}
+        assert calls[1][2] == {'ref': "refs/tags/20220216-0918-develop1", 'sha': "tagsha"}
+
+        # commits that were just looked up aren't verified again
+        monkeypatch.setattr(ghlib, "verify_commit", lambda url, commit, token: False)
+        assert ghlib.tag_repo(repo, "token", verify=False)
+        assert not ghlib.tag_repo(repo, "token")
+
+        # failures are reported back to tag_repos instead of exiting
+        monkeypatch.setattr(ghlib.SESSION, "request",
+                            lambda method, url, **kwargs: make_response(422, {'message': "exists"}))
+        assert not ghlib.tag_repo(repo, "token")
+
+    def test_container_url(self):
+        """
+        Test generation of container urls for each registry
+        :return: None
+        """
+        repo = repoinfo.RepoInfo("test1", "develop", "develop1", "calver",
+                                 container_repo="sslhep/test1", container_registry="dockerhub")
+        assert repoinfo.container_url(repo, "1.0") == \
+            "https://hub.docker.com/v2/repositories/sslhep/test1/tags/1.0"
+        repo.container_registry = "harbor"
+        assert repoinfo.container_url(repo, "1.0") == \
+            "https://hub.opensciencegrid.org/sslhep/sslhep/test1/tags/1.0"
+        repo.container_registry = ""
+        assert repoinfo.container_url(repo, "1.0") == ""
+        # other registries are queried through the OCI distribution API
+        repo.container_registry = "ghcr.io"
+        assert repoinfo.container_url(repo, "1.0") == \
+            "https://ghcr.io/v2/sslhep/test1/manifests/1.0"
+        repo.container_registry = "dockerhub"
+        assert repoinfo.container_url(repo, "1.0", "mirror.example.org") == \
+            "https://mirror.example.org/v2/sslhep/test1/manifests/1.0"
+
+    def test_ingest_config_cache(self, monkeypatch, tmp_path, config_cache_dir):
+        """
+        Test that parsed configs are reused until the config file changes
+        :return: None
+        """
+        config_file = tmp_path / "repos.toml"
+        config_file.write_text(pathlib.Path(VALID_TEST_FILE).read_text())
+        parsed = util.ingest_config(config_file)
+        assert len(list(config_cache_dir.iterdir())) == 1
+
+        def fail_parse(config):
+            raise AssertionError("config parsed again")
+
+        monkeypatch.setattr(util, "parse_config", fail_parse)
+        assert util.ingest_config(config_file) == parsed
+        config_file.write_text(config_file.read_text() + "\n")
+        monkeypatch.setattr(util, "parse_config", lambda config: ([], []))
+        assert util.ingest_config(config_file) == []
+
+    def test_ingest_config_cache_warnings(self, tmp_path, caplog):
+        """
+        Test that warnings about a config are shown again when the cached config is used
+        :return: None
+        """
+        config_file = tmp_path / "repos.toml"
+        config_file.write_text('[test1]\nbranch = "develop"\nlabel = "develop1"\n'
+                               'tagtype = "calver"\ncolour = "blue"\n')
+        for _ in range(2):
+            caplog.clear()
+            assert len(util.ingest_config(config_file)) == 1
+            assert "Unknown setting colour in section test1" in caplog.text
+
+    def test_check_repos_early_exit(self, monkeypatch):
+        """
+        Test that check_repos stops at the first repo with a missing branch
+        :return: None
+        """
+        config = util.ingest_config(pathlib.Path(INVALID_TEST_FILE))
+        monkeypatch.setattr(release_tool, "update_branch_config",
+                            lambda repo, token: repo.branch != "missing")
+        assert not release_tool.check_repos(config)
+        config = util.ingest_config(pathlib.Path(VALID_TEST_FILE))
+        assert release_tool.check_repos(config)
+
+    def test_confirm(self, monkeypatch):
+        """
+        Test that confirmations don't block when not running interactively
+        :return: None
+        """
+        monkeypatch.setattr("builtins.input", lambda message: "y")
+        monkeypatch.setattr(release_tool, "ASSUME_YES", False)
+        monkeypatch.setattr(release_tool, "INTERACTIVE", True)
+        assert release_tool.confirm("Apply tags (y/N)? ")
+        monkeypatch.setattr(release_tool, "INTERACTIVE", False)
+        assert not release_tool.confirm("Apply tags (y/N)? ")
+        with pytest.raises(SystemExit):
+            release_tool.prompt("Chart version to publish? ")
+        monkeypatch.setattr(release_tool, "ASSUME_YES", True)
+        assert release_tool.confirm("Apply tags (y/N)? ")
+
+    def test_setup_logging(self, monkeypatch):
+        """
+        Test that rich only handles logging when output goes to a terminal
+        :return: None
+        """
+        configs = []
+        monkeypatch.setattr(release_tool.logging, "basicConfig",
+                            lambda **kwargs: configs.append(kwargs))
+        monkeypatch.setattr(release_tool, "CONSOLE", rich.console.Console(force_terminal=False))
+        release_tool.setup_logging(False)
+        assert 'handlers' not in configs[-1]
+        assert configs[-1]['level'] == "INFO"
+        monkeypatch.setattr(release_tool, "CONSOLE", rich.console.Console(force_terminal=True))
+        release_tool.setup_logging(True)
+        assert type(configs[-1]['handlers'][0]).__name__ == "RichHandler"
+        assert configs[-1]['level'] == "DEBUG"
+
+    def test_get_token_keyring(self, monkeypatch):
+        """
+        Test that a token saved in the keyring is used instead of prompting
+        :return: None
+        """
+        keyring = types.ModuleType("keyring")
+        keyring.errors = types.ModuleType("keyring.errors")
+        keyring.errors.KeyringError = Exception
+        keyring.get_password = lambda service, user: "ghp_keyring"
+        monkeypatch.setitem(sys.modules, "keyring", keyring)
+        monkeypatch.setitem(sys.modules, "keyring.errors", keyring.errors)
+        monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+        monkeypatch.delenv("GITHUB_APP_ID", raising=False)
+        monkeypatch.setattr(ghlib, "valid_gh_token", lambda token: True)
+        monkeypatch.setattr(release_tool, "INTERACTIVE", True)
+        monkeypatch.setattr(release_tool, "prompt", lambda message: pytest.fail("prompted"))
+        assert release_tool.get_token() == "ghp_keyring"
+
+        # the keyring isn't touched when nobody is there to unlock it
+        monkeypatch.setattr(release_tool, "INTERACTIVE", False)
+        monkeypatch.setattr(release_tool, "prompt", lambda message: "ghp_prompt")
+        assert release_tool.get_token() == "ghp_prompt"
+
+    def test_context_token(self, monkeypatch):
+        """
+        Test that the token is requested and validated once per invocation
+        :return: None
+        """
+        checks = []
+
+        def fake_valid(token):
+            checks.append(token)
+            return True
+
+        monkeypatch.setattr(release_tool, "get_token", lambda: "ghp_token")
+        monkeypatch.setattr(ghlib, "valid_gh_token", fake_valid)
+        ctx = types.SimpleNamespace(obj={})
+        assert release_tool.context_token(ctx) == "ghp_token"
+        assert release_tool.context_token(ctx) == "ghp_token"
+        assert ctx.obj['token_valid']
+        assert checks == ["ghp_token"]
+
+    def test_check_repos_graphql(self, monkeypatch):
+        """
+        Test that branches are looked up with one GraphQL query and unresolved repos use REST
+        :return: None
+        """
+        queries = []
+
+        def fake_graphql(query, variables, token):
+            queries.append(variables)
+            return {'r0': {'ref': {'target': {'oid': "abc123"}}}, 'r1': None}
+
+        rest_lookups = []
+
+        def fake_update(repo, token):
+            rest_lookups.append(repo.name)
+            repo.commit = "def456"
+            return True
+
+        monkeypatch.setattr(ghlib, "graphql", fake_graphql)
+        monkeypatch.setattr(release_tool, "update_branch_config", fake_update)
+        repos = [repoinfo.RepoInfo("test1", "develop", "develop1", "calver"),
+                 repoinfo.RepoInfo("test2", "master", "develop1", "calver")]
+        assert release_tool.check_repos(repos, "token")
+        assert len(queries) == 1
+        assert queries[0]['branch1'] == "refs/heads/master"
+        assert rest_lookups == ["test2"]
+        assert [repo.commit for repo in repos] == ["abc123", "def456"]
+
+        monkeypatch.setattr(ghlib, "graphql", lambda query, variables, token: {'r0': {'ref': None}})
+        assert not release_tool.check_repos(repos, "token")
+
+    def test_tag_prompts_first(self, monkeypatch):
+        """
+        Test that tag asks all its questions before tagging and monitoring start
+        :return: None
+        """
+        events = []
+
+        def stub(name):
+            @click.command()
+            @click.option("--tag")
+            @click.option("--workflow_time")
+            @click.option("--chart_version")
+            def command(**kwargs):
+                events.append(name)
+            return command
+
+        monkeypatch.setattr(release_tool, "context_token", lambda ctx: "token")
+        monkeypatch.setattr(release_tool, "tag_repos",
+                            lambda repos, token: events.append("tag_repos") or "1.0")
+        monkeypatch.setattr(release_tool, "prompt",
+                            lambda message: events.append("prompt") or "2.0.0")
+        monkeypatch.setattr(release_tool, "confirm", lambda message: events.append("confirm") or True)
+        for name in ["monitor_workflows", "verify_containers", "release"]:
+            monkeypatch.setattr(release_tool, name, stub(name))
+        runner = click.testing.CliRunner()
+        result = runner.invoke(release_tool.tag, ["--publish", "true"], obj={'repo_configs': []})
+        assert result.exit_code == 0
+        assert events == ["prompt", "confirm", "tag_repos", "monitor_workflows",
+                          "verify_containers", "release"]
+
+    def test_verify_containers(self, monkeypatch, caplog):
+        """
+        Test that container checks run for every repo with a registry and fail on missing ones
+        :return: None
+        """
+        repos = [repoinfo.RepoInfo(f"test{i}", "develop", "develop1", "calver",
+                                   container_repo=f"sslhep/test{i}",
+                                   container_registry="dockerhub")
+                 for i in range(4)]
+        repos.append(repoinfo.RepoInfo("test4", "develop", "develop1", "calver"))
+        checked = []
+
+        def fake_find(repo, tag, registry=None):
+            checked.append(repo.name)
+            return True
+
+        monkeypatch.setattr(release_tool, "find_container", fake_find)
+        runner = click.testing.CliRunner()
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos, 'use_cache': False})
+        assert result.exit_code == 0
+        assert sorted(checked) == ["test0", "test1", "test2", "test3"]
+
+        # every repo publishing to the missing image is reported
+        repos.append(repoinfo.RepoInfo("test5", "develop", "develop1", "calver",
+                                       container_repo="sslhep/test2",
+                                       container_registry="dockerhub"))
+        monkeypatch.setattr(release_tool, "find_container",
+                            lambda repo, tag, registry=None: repo.name != "test2")
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos, 'use_cache': False})
+        assert result.exit_code == 1
+        assert "for test2, test5" in caplog.text
+
+    def test_verify_containers_cache(self, monkeypatch, container_cache_path):
+        """
+        Test that containers found by earlier runs aren't looked up again
+        :return: None
+        """
+        repos = [repoinfo.RepoInfo(f"test{i}", "develop", "develop1", "calver",
+                                   container_repo=f"sslhep/test{i}",
+                                   container_registry="dockerhub")
+                 for i in range(3)]
+        checked = []
+
+        def fake_find(repo, tag, registry=None):
+            checked.append(repo.name)
+            return repo.name != "test2"
+
+        monkeypatch.setattr(release_tool, "find_container", fake_find)
+        runner = click.testing.CliRunner()
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos})
+        assert result.exit_code == 1
+        # found containers are saved even though the check failed
+        assert sorted(json.loads(container_cache_path.read_text())) == \
+            ["https://hub.docker.com/v2/repositories/sslhep/test0/tags/1.0",
+             "https://hub.docker.com/v2/repositories/sslhep/test1/tags/1.0"]
+
+        checked.clear()
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos})
+        assert result.exit_code == 1
+        assert checked == ["test2"]
+
+        # repos sharing an image only have it looked up once
+        checked.clear()
+        shared = repoinfo.RepoInfo("test3", "develop", "develop1", "calver",
+                                   container_repo="sslhep/test1", container_registry="dockerhub")
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos + [shared], 'use_cache': False})
+        assert sorted(checked) == ["test0", "test1", "test2"]
+
+        # the cache isn't used with --no-cache
+        checked.clear()
+        result = runner.invoke(release_tool.verify_containers, ["--tag", "1.0"],
+                               obj={'repo_configs': repos, 'use_cache': False})
+        assert sorted(checked) == ["test0", "test1", "test2"]
+
+    def test_find_container(self, monkeypatch):
+        """
+        Test that container tags are checked with HEAD requests and unexpected replies fail
+        :return: None
+        """
+        repo = repoinfo.RepoInfo("test1", "develop", "develop1", "calver",
+                                 container_repo="sslhep/test1", container_registry="dockerhub")
+        calls = []
+
+        def fake_request(status):
+            def request(url, **kwargs):
+                calls.append(url)
+                return make_response(status)
+            return request
+
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "head", fake_request(200))
+        assert release_tool.find_container(repo, "1.0")
+        assert calls == ["https://hub.docker.com/v2/repositories/sslhep/test1/tags/1.0"]
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "head", fake_request(404))
+        assert not release_tool.find_container(repo, "1.0")
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "head", fake_request(429))
+        assert not release_tool.find_container(repo, "1.0")
+
+        # registries that don't support HEAD are asked with a GET
+        calls.clear()
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "head", fake_request(405))
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "get", fake_request(200))
+        assert release_tool.find_container(repo, "1.0")
+        assert len(calls) == 2
+
+    def test_find_container_oci(self, monkeypatch):
+        """
+        Test that OCI registries are checked for manifests with an anonymous token
+        :return: None
+        """
+        repo = repoinfo.RepoInfo("test1", "develop", "develop1", "calver",
+                                 container_repo="sslhep/test1", container_registry="ghcr.io")
+        heads = []
+        challenge = 'Bearer realm="https://ghcr.io/token",service="ghcr.io",' \
+                    'scope="repository:sslhep/test1:pull"'
+
+        def fake_head(url, headers, **kwargs):
+            heads.append(dict(headers))
+            if 'Authorization' not in headers:
+                return make_response(401, headers={'Www-Authenticate': challenge})
+            return make_response(200)
+
+        def fake_get(url, params, **kwargs):
+            assert url == "https://ghcr.io/token"
+            assert params == {'service': "ghcr.io", 'scope': "repository:sslhep/test1:pull"}
+            return make_response(200, {'token': "anonymous"})
+
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "head", fake_head)
+        monkeypatch.setattr(release_tool.REGISTRY_SESSION, "get", fake_get)
+        assert release_tool.find_container(repo, "1.0")
+        assert heads[1]['Authorization'] == "Bearer anonymous"
+        assert "application/vnd.oci.image.manifest.v1+json" in heads[1]['Accept']
+
+    def test_get_etag_cache(self, monkeypatch):
+        """
+        Test that cached responses are reused on a 304 and that the cache is bounded
+        :return: None
+        """
+        requests_sent = []
+
+        def fake_request(method, url, **kwargs):
+            requests_sent.append((url, kwargs['headers']))
+            if kwargs['headers'].get('If-None-Match') == '"etag"':
+                return make_response(304)
+            return make_response(200, {'url': url}, {'ETag': '"etag"'})
+
+        monkeypatch.setattr(ghlib, "_ETAG_CACHE", collections.OrderedDict())
+        monkeypatch.setattr(ghlib, "ETAG_CACHE_SIZE", 2)
+        monkeypatch.setattr(ghlib.SESSION, "request", fake_request)
+        url = "https://api.github.com/repos/ssl-hep/test1"
+        first = ghlib.get(url, "token")
+        second = ghlib.get(url, "token")
+        assert second is first
+        assert second.status_code == 200
+        assert second.json() == {'url': url}
+        assert requests_sent[1][1]['If-None-Match'] == '"etag"'
+
+        # responses for a different token aren't reused
+        ghlib.get(url)
+        assert 'If-None-Match' not in requests_sent[2][1]
+
+        # oldest entry is evicted once the cache is full
+        ghlib.get(url + "/branches", "token")
+        assert (url, "token") not in ghlib._ETAG_CACHE
+        assert len(ghlib._ETAG_CACHE) == 2
+
+    def test_get_disk_cache(self, monkeypatch, tmp_path):
+        """
+        Test that ETags saved on disk are used after the memory cache is gone
+        and that changes to a repo invalidate its cached responses
+        :return: None
+        """
+        requests_sent = []
+
+        def fake_request(method, url, **kwargs):
+            requests_sent.append((method, url, kwargs['headers']))
+            if method == 'POST':
+                return make_response(201)
+            if kwargs['headers'].get('If-None-Match') == '"etag"':
+                return make_response(304)
+            return make_response(200, {'url': url}, {'ETag': '"etag"'})
+
+        monkeypatch.setattr(ghlib, "_ETAG_CACHE", collections.OrderedDict())
+        monkeypatch.setattr(ghlib, "_DISK_CACHE", None)
+        monkeypatch.setattr(ghlib.SESSION, "request", fake_request)
+        ghlib.enable_disk_cache(tmp_path / "cache" / "etags.sqlite")
+        url = "https://api.github.com/repos/ssl-hep/test1/branches/develop"
+        ghlib.get(url, "token")
+        ghlib._ETAG_CACHE.clear()
+        cached = ghlib.get(url, "token")
+        assert requests_sent[1][2]['If-None-Match'] == '"etag"'
+        assert cached.status_code == 200
+        assert cached.json() == {'url': url}
+        assert cached.headers['etag'] == '"etag"'
+
+        ghlib.request('POST', "https://api.github.com/repos/ssl-hep/test1/git/tags", headers={})
+        assert not ghlib._ETAG_CACHE
+        ghlib.get(url, "token")
+        assert 'If-None-Match' not in requests_sent[3][2]
+
+    def test_disk_cache_storage(self, monkeypatch, tmp_path):
+        """
+        Test that the disk cache is private to the user and old responses are dropped
+        :return: None
+        """
+        monkeypatch.setattr(ghlib, "_DISK_CACHE", None)
+        monkeypatch.setattr(ghlib, "DISK_CACHE_MAX_ROWS", 2)
+        path = tmp_path / "cache" / "etags.sqlite"
+        ghlib.enable_disk_cache(path)
+        assert path.parent.stat().st_mode & 0o777 == 0o700
+        assert path.stat().st_mode & 0o777 == 0o600
+        now = time.time()
+        for i, used in enumerate([now - ghlib.DISK_CACHE_MAX_AGE - 1, now - 2, now - 1, now]):
+            with ghlib._DISK_CACHE:
+                ghlib._DISK_CACHE.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          (f"url{i}", "token", "etag", 200, "{}", b"", used))
+        ghlib.enable_disk_cache(path)
+        rows = ghlib._DISK_CACHE.execute("SELECT url FROM responses ORDER BY url").fetchall()
+        assert rows == [("url2",), ("url3",)]
+
+    def test_get_workflow_statuses(self, monkeypatch):
+        """
+        Test that concurrently fetched workflow statuses keep the order of the urls
+        :return: None
+        """
+        def fake_status(url, token):
+            time.sleep(0.01 * (5 - int(url[-1])))
+            return {'url': url, 'conclusion': "success" if url[-1] != "3" else None}
+
+        monkeypatch.setattr(ghlib, "get_workflow_status", fake_status)
+        workflow_info = {'test1': ["run0", "run1"], 'test2': ["run2", "run3", "run4"]}
+        urls = ghlib.workflow_url_list(workflow_info)
+        statuses = ghlib.get_workflow_statuses(urls, "token")
+        assert [status['url'] for status in statuses] == urls
+        assert not ghlib.workflows_complete(workflow_info, "token", statuses)
+        assert not ghlib.workflows_complete(workflow_info, "token")
+        del workflow_info['test2']
+        assert ghlib.workflows_complete(workflow_info, "token")
+
+    def test_get_workflow_statuses_finished(self, monkeypatch):
+        """
+        Test that finished workflows aren't queried again
+        :return: None
+        """
+        queried = []
+
+        def fake_status(url, token):
+            queried.append(url)
+            return {'url': url, 'conclusion': "success" if url == "run0" else None}
+
+        monkeypatch.setattr(ghlib, "get_workflow_status", fake_status)
+        finished: dict[str, dict[str, str]] = {}
+        ghlib.get_workflow_statuses(["run0", "run1"], "token", finished)
+        assert list(finished) == ["run0"]
+        queried.clear()
+        statuses = ghlib.get_workflow_statuses(["run0", "run1"], "token", finished)
+        assert queried == ["run1"]
+        assert [status['url'] for status in statuses] == ["run0", "run1"]
+
+    def test_workflow_time_window(self):
+        """
+        Test formatting of the creation time range used to find workflows
+        :return: None
+        """
+        naive = datetime.datetime(2022, 2, 16, 9, 18)
+        aware = datetime.datetime(2022, 2, 16, 10, 18,
+                                  tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+        expected = "2022-02-16T09:13:00Z..2022-02-16T09:23:00Z"
+        assert ghlib.workflow_time_window(naive) == expected
+        assert ghlib.workflow_time_window(aware) == expected
+
+    def test_get_workflow_status(self, monkeypatch):
+        """
+        Test that workflow status reports the last job of the run
+        :return: None
+        """
+        run = {'workflow_id': 1, 'status': "completed", 'conclusion': "success",
+               'html_url': "https://github.com/ssl-hep/test/actions/runs/1",
+               'jobs_url': "https://api.github.com/repos/ssl-hep/test/actions/runs/1/jobs"}
+        jobs = {'jobs': [{'name': "build", 'status': "completed"},
+                         {'name': "publish", 'status': "in_progress"}]}
+        urls = []
+
+        def fake_get(url, token):
+            urls.append(url)
+            return make_response(200, jobs if "jobs" in url else run)
+
+        monkeypatch.setattr(ghlib, "get", fake_get)
+        status = ghlib.get_workflow_status("runs/1", "token")
+        assert urls[1] == run['jobs_url']
+        assert status['job_name'] == "publish"
+        assert status['job_status'] == "in_progress"
+
+    def test_get_workflows_by_tag(self, monkeypatch):
+        """
+        Test parsing of the batched GraphQL workflow query and REST fallbacks
+        :return: None
+        """
+        def suite(run_id, branch, created):
+            return {'branch': {'name': branch} if branch else None,
+                    'workflowRun': {'databaseId': run_id, 'event': "push", 'createdAt': created}}
+
+        tagged_commit = {'tagger': {'date': "2022-02-16T09:18:00Z"},
+                         'target': {'checkSuites': {
+                             'pageInfo': {'hasNextPage': False},
+                             'nodes': [suite(1, None, "2022-02-16T09:18:05Z"),
+                                       suite(2, "develop", "2022-02-16T09:18:05Z"),
+                                       suite(3, None, "2022-02-10T12:00:00Z")]}}}
+        queries = []
+
+        def fake_graphql(query, variables, token):
+            queries.append(variables)
+            return {'r0': {'ref': {'target': tagged_commit}},
+                    'r1': {'ref': None},
+                    'r2': None}
+
+        rest_lookups = []
+        monkeypatch.setattr(ghlib, "graphql", fake_graphql)
+        monkeypatch.setattr(ghlib, "get_repo_workflow_by_tag",
+                            lambda repo, tag, token: rest_lookups.append(repo.name) or ["rest"])
+        configs = [repoinfo.RepoInfo(name, "develop", "develop1", "calver")
+                   for name in ["test1", "test2", "test3"]]
+        workflow_info = ghlib.get_workflows_by_tag(configs, "20220216-0918-develop1", "token")
+        assert workflow_info == {
+            'test1': ["https://api.github.com/repos/ssl-hep/test1/actions/runs/1"],
+            'test2': [],
+            'test3': ["rest"]}
+        assert rest_lookups == ["test3"]
+        assert queries[0]['name0'] == "test1"
+        assert queries[0]['ref'] == "refs/tags/20220216-0918-develop1"
+
+    def test_get_deduplication(self, monkeypatch):
+        """
+        Test that a GET request matching one in flight shares its response
+        :return: None
+        """
+        calls = []
+        monkeypatch.setattr(ghlib.SESSION, "request",
+                            lambda method, url, **kwargs: calls.append(url) or make_response(200))
+        url = "https://api.github.com/repos/ssl-hep/test1"
+        pending: concurrent.futures.Future = concurrent.futures.Future()
+        response = make_response(200, {'url': url})
+        pending.set_result(response)
+        monkeypatch.setitem(ghlib._INFLIGHT, (url, "token"), pending)
+        assert ghlib.get(url, "token") is response
+        assert calls == []
+        monkeypatch.delitem(ghlib._INFLIGHT, (url, "token"))
+        ghlib.get(url, "token")
+        assert calls == [url]
+        assert not ghlib._INFLIGHT
+
+    def test_rate_limiter(self, monkeypatch):
+        """
+        Test that the rate limiter slows down after rate limits and recovers
+        :return: None
+        """
+        sleeps = []
+        monkeypatch.setattr(ghlib.time, "sleep", sleeps.append)
+        limiter = ghlib.RateLimiter(10, 2)
+        for _ in range(3):
+            limiter.acquire()
+        assert len(sleeps) == 1 and 0 < sleeps[0] <= 0.1
+        limiter.update(make_response(429))
+        assert limiter.rate == 5
+        for _ in range(ghlib.RATE_RECOVERY_REQUESTS):
+            limiter.update(make_response(200))
+        assert limiter.rate == 10
+        reset = str(time.time() + 100)
+        limiter.update(make_response(200, headers={'X-RateLimit-Limit': "5000",
+                                                   'X-RateLimit-Remaining': "100",
+                                                   'X-RateLimit-Reset': reset}))
+        assert limiter.rate <= 1.01
+
+    def test_valid_gh_token(self):
+        """
+        Test that token prefixes for fine-grained PATs and other token types are accepted
+        :return: None
+        """
+        for token in ["ghp_abc", "github_pat_abc", "gho_abc", "ghs_abc", "ghr_abc"]:
+            assert ghlib.valid_gh_token(token, query=False)
+        assert not ghlib.valid_gh_token("abc", query=False)
+        assert not ghlib.valid_gh_token(None, query=False)
+
+    def test_app_installation_token(self, monkeypatch):
+        """
+        Test that requests made with an app's token use a current installation token
+        :return: None
+        """
+        tokens = iter(["ghs_first", "ghs_first", "ghs_second"])
+        monkeypatch.setattr(ghlib, "get_installation_token",
+                            lambda app_id, private_key, installation_id: next(tokens))
+        monkeypatch.setattr(ghlib, "_APP_INSTALLATIONS", {})
+        token = ghlib.app_installation_token("1", "key", "2")
+        assert token == "app-installation:1/2"
+        assert ghlib.auth_headers(token)['Authorization'] == "token ghs_first"
+        # a new installation token is used once the previous one expires
+        assert ghlib.auth_headers(token)['Authorization'] == "token ghs_second"
+        assert ghlib.auth_headers("ghp_pat")['Authorization'] == "token ghp_pat"
+
+        monkeypatch.setattr(ghlib, "get_installation_token",
+                            lambda app_id, private_key, installation_id: "")
+        assert ghlib.app_installation_token("1", "key", "3") == ""
+
+    def test_get_installation_token(self, monkeypatch):
+        """
+        Test that installation tokens are reused until they are about to expire
+        :return: None
+        """
+        calls = []
+
+        def fake_request(method, url, **kwargs):
+            calls.append(url)
+            return make_response(201, {'token': "ghs_new", 'expires_at': "2099-01-01T00:00:00Z"})
+
+        monkeypatch.setattr(ghlib, "request", fake_request)
+        monkeypatch.setattr(ghlib, "_INSTALLATION_TOKENS", {})
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ghlib._INSTALLATION_TOKENS[("1", "2")] = ("ghs_cached", now + datetime.timedelta(hours=1))
+        assert ghlib.get_installation_token("1", "key", "2") == "ghs_cached"
+        assert calls == []
+        assert ghlib.valid_gh_token("ghs_cached", query=False)
+        ghlib._INSTALLATION_TOKENS[("1", "2")] = ("ghs_cached", now + datetime.timedelta(minutes=1))
+        jwt = types.ModuleType("jwt")
+        jwt.encode = lambda payload, key, algorithm: "app-jwt"
+        monkeypatch.setitem(sys.modules, "jwt", jwt)
+        assert ghlib.get_installation_token("1", "key", "2") == "ghs_new"
+        assert calls == ["https://api.github.com/app/installations/2/access_tokens"]
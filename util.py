@@ -1,65 +1,116 @@
-import glob
-import os
+import hashlib
+import logging
 import pathlib
+import pickle
+import re
 import shutil
+import subprocess
+import sys
 import time
 
-import toml
+if sys.version_info >= (3, 11):
+  import tomllib
+else:
+  import tomli as tomllib
 import yaml
 
 from repoinfo import RepoInfo
 from error_handling import error, warn
 
+# use the libyaml bindings when PyYAML was built with them
+try:
+  from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+  from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader  # type: ignore[assignment]
+
+# a "key: value" line in a yaml mapping, with any trailing comment kept out of the value
+YAML_KEY_RE = re.compile(r"^(?P<indent> *)(?P<key>[\w.-]+):[ \t]*"
+                         r"(?P<value>[^#\r\n]*?)[ \t]*(?:#.*)?$")
+
+# parsed configurations are cached here so unchanged config files aren't parsed again
+CONFIG_CACHE_DIR = pathlib.Path("~/.cache/ssl-hep-release-tool/config").expanduser()
+
+# settings that can be given for each repo in a config file
+CONFIG_SETTINGS = frozenset(['branch', 'label', 'tagtype', 'semver', 'commit',
+                             'container_repo', 'container_registry'])
+REQUIRED_SETTINGS = ('branch', 'label', 'tagtype')
+
 
 def ingest_config(config_file: pathlib.Path) -> list[RepoInfo]:
   """
-  Ingest configuration information
+  Ingest configuration information, the parsed configuration is cached and
+  reused as long as the file's modification time and size don't change
 
   :param config_file: name of file with configuration
   :return: dictionary with repo information (key -> dict with repo values)
   """
-  parsed = toml.load(config_file)
+  stat = config_file.stat()
+  # RepoInfo's fields are part of the key so caches written before they changed aren't used
+  file_key = (stat.st_mtime_ns, stat.st_size, RepoInfo.__slots__)
+  path_hash = hashlib.sha1(str(config_file.resolve()).encode()).hexdigest()
+  cache_path = CONFIG_CACHE_DIR / f"{path_hash}.pickle"
+  try:
+    with cache_path.open('rb') as f:
+      cached_key, repos, warnings = pickle.load(f)
+    if cached_key != file_key:
+      raise ValueError("configuration changed")
+  except (OSError, pickle.PickleError, EOFError, ValueError, TypeError, AttributeError):
+    repos, warnings = parse_config(config_file)
+    try:
+      CONFIG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+      with cache_path.open('wb') as f:
+        pickle.dump((file_key, repos, warnings), f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+      pass
+  # warnings are cached with the configuration so they're shown on every run
+  for warning in warnings:
+    warn(warning)
+  return repos
+
+
+def parse_config(config_file: pathlib.Path) -> tuple[list[RepoInfo], list[str]]:
+  """
+  Parse a configuration file, exits if the configuration has problems
+
+  :param config_file: name of file with configuration
+  :return: list with repo information and list of warnings about the configuration
+  """
+  with config_file.open('rb') as f:
+    parsed = tomllib.load(f)
   repos = []
-  for key in parsed.keys():
-    branch = None
-    label = ""
-    tagtype = ""
-    commit = ""
-    semver = ""
-    container_repo = ""
-    container_registry = ""
-    for setting in ['branch', 'label', 'tagtype', 'commit', 'container_repo', 'container_registry']:
-      match setting:
-        case 'branch': branch = parsed[key][setting]
-        case 'label': label = parsed[key][setting]
-        case 'tagtype':
-          tagtype = parsed[key][setting].lower()
-          if tagtype == 'semver':
-            semver = parsed[key]['semver']
-        case 'commit':
-          if 'commit' in parsed[key]:
-            commit = parsed[key][setting].lower()
-        case 'container_repo':
-          if 'container_repo' in parsed[key]:
-            container_repo = parsed[key][setting].lower()
-        case 'container_registry':
-          if 'container_registry' in parsed[key]:
-            container_registry = parsed[key][setting].lower()
-        case _: warn(f"Unknown setting {setting} in section {key}")
-    if branch is None:
-      error(f"Section {key} missing branch setting")
-    if label is None:
-      error(f"Section {key} missing label setting")
-    if tagtype is None:
-      error(f"Section {key} missing tagtype setting")
+  # every problem in the file is reported before exiting so they can all be fixed at once
+  problems: list[str] = []
+  warnings: list[str] = []
+  for key, section in parsed.items():
+    for setting in section.keys() - CONFIG_SETTINGS:
+      warnings.append(f"Unknown setting {setting} in section {key}")
+    missing = [setting for setting in REQUIRED_SETTINGS if section.get(setting) is None]
+    if missing:
+      problems.extend(f"Section {key} missing {setting} setting" for setting in missing)
+      continue
+    branch = section['branch']
+    tagtype = section['tagtype'].lower()
     if tagtype not in ['semver', 'calver']:
-      error(f"In section {key}, tagtype must be 'semver' or 'calver', got {tagtype}")
+      problems.append(f"In section {key}, tagtype must be 'semver' or 'calver', got {tagtype}")
+      continue
+    semver = section.get('semver', "") if tagtype == 'semver' else ""
+    if tagtype == 'semver' and not semver:
+      problems.append(f"Section {key} missing semver setting, needed when tagtype is 'semver'")
+      continue
+    commit = section.get('commit', "").lower()
     if branch and commit:
-      warn(f"In section {key}, branch and commit both set, using commit")
-    repos.append(RepoInfo(name=key, branch=branch, label=label,
+      warnings.append(f"In section {key}, branch and commit both set, using commit")
+    repos.append(RepoInfo(name=key, branch=branch, label=section['label'],
                           tagtype=tagtype, semver=semver, commit=commit,
-                          container_repo=container_repo, container_registry=container_registry))
-  return repos
+                          container_repo=section.get('container_repo', "").lower(),
+                          container_registry=section.get('container_registry', "").lower()))
+  if problems:
+    for warning in warnings:
+      warn(warning)
+    for problem in problems:
+      error(problem, abort=False)
+    error(f"Invalid configuration in {config_file}")
+  return repos, warnings
 
 
 def generate_calver(date: time.struct_time = None) -> str:
@@ -68,12 +119,60 @@ def generate_calver(date: time.struct_time = None) -> str:
   :param date: optional date
   :return: string with calver
   """
-  if date:
-    target_date = date
-  else:
-    target_date = time.gmtime()
-  return f"{target_date.tm_year:04}{target_date.tm_mon:02}{target_date.tm_mday:02}-" \
-         f"{target_date.tm_hour:02}{target_date.tm_min:02}"
+  return time.strftime("%Y%m%d-%H%M", date or time.gmtime())
+
+
+def set_yaml_scalars(text: str, updates: dict[tuple[str, ...], str]) -> str:
+  """
+  Set scalar values in yaml text by editing the lines holding them, so
+  comments and formatting elsewhere in the document are left alone
+  :param text: yaml document
+  :param updates: new values keyed by the path of mapping keys leading to them
+  :return: yaml document with the values replaced
+  """
+  lines = text.splitlines(keepends=True)
+  parents: list[tuple[int, str]] = []
+  for i, line in enumerate(lines):
+    match = YAML_KEY_RE.match(line)
+    if not match:
+      continue
+    indent = len(match.group('indent'))
+    while parents and parents[-1][0] >= indent:
+      parents.pop()
+    key = match.group('key')
+    path = tuple(parent for _, parent in parents) + (key,)
+    if path in updates and match.group('value'):
+      value = yaml.dump(updates[path], Dumper=YamlDumper).removesuffix("...\n").strip()
+      lines[i] = line[:match.start('value')] + value + line[match.end('value'):]
+    parents.append((indent, key))
+  return "".join(lines)
+
+
+def update_yaml_file(file_path: pathlib.Path, updates: dict[tuple[str, ...], str]) -> None:
+  """
+  Replace values in a yaml file, only values that are already present are
+  changed.  The file is edited in place when possible and only re-emitted
+  from the parsed document if the edit doesn't give the expected result
+  :param file_path: path to yaml file
+  :param updates: new values keyed by the path of mapping keys leading to them
+  :return: None
+  """
+  text = file_path.read_text()
+  values = yaml.load(text, YamlLoader)
+  present = {}
+  for path, value in updates.items():
+    parent = values
+    for key in path[:-1]:
+      parent = parent.get(key) if isinstance(parent, dict) else None
+    if isinstance(parent, dict) and path[-1] in parent:
+      parent[path[-1]] = value
+      present[path] = value
+  new_text = set_yaml_scalars(text, present)
+  if yaml.load(new_text, YamlLoader) != values:
+    new_text = yaml.dump(values, Dumper=YamlDumper)
+  new_file = file_path.with_name(file_path.name + ".new")
+  new_file.write_text(new_text)
+  new_file.replace(file_path)
 
 
 def replace_tags(file_path: pathlib.Path, new_tag: str) -> None:
@@ -85,16 +184,10 @@ def replace_tags(file_path: pathlib.Path, new_tag: str) -> None:
   """
   if not file_path.is_file():
     return
-  with file_path.open() as f:
-    values = yaml.load(f, yaml.SafeLoader)
-    for section in ['app', 'didFinder', 'CERNOpenData', 'codeGen', 'x509Secrets']:
-      if section in values and 'tag' in values[section]:
-        values[section]['tag'] = new_tag
-    if 'transformer' in values and 'defaultTransformerTag' in values['transformer']:
-      values['transformer']['defaultTransformerTag'] = new_tag
-  new_file = file_path.with_name("values.yaml.new")
-  yaml.safe_dump(values, new_file.open('w'))
-  new_file.replace(file_path)
+  sections = ['app', 'didFinder', 'CERNOpenData', 'codeGen', 'x509Secrets']
+  updates: dict[tuple[str, ...], str] = {(section, 'tag'): new_tag for section in sections}
+  updates[('transformer', 'defaultTransformerTag')] = new_tag
+  update_yaml_file(file_path, updates)
 
 
 def replace_appver(file_path: pathlib.Path, new_tag: str, release_version: str) -> None:
@@ -107,15 +200,7 @@ def replace_appver(file_path: pathlib.Path, new_tag: str, release_version: str)
   """
   if not file_path.is_file():
     return
-  with file_path.open() as f:
-    values = yaml.load(f, yaml.SafeLoader)
-    if 'appVersion' in values:
-      values['appVersion'] = new_tag
-    if 'version' in values:
-      values['version'] = release_version
-  new_file = file_path.with_name("Chart.yaml.new")
-  yaml.safe_dump(values, new_file.open('w'))
-  new_file.replace(file_path)
+  update_yaml_file(file_path, {('appVersion',): new_tag, ('version',): release_version})
 
 
 def generate_helm_package(chart_dir: pathlib.Path, chart_repo_dir: pathlib.Path) -> None:
@@ -127,22 +212,29 @@ def generate_helm_package(chart_dir: pathlib.Path, chart_repo_dir: pathlib.Path)
   """
   if not chart_dir.is_dir() or not chart_repo_dir.is_dir():
     return
-  cur_dir = os.getcwd()
+  if not run_command(["helm", "dependency", "update", "servicex"], chart_dir):
+    error("Can't update helm dependencies for ServiceX")
+  if not run_command(["helm", "package", "servicex"], chart_dir):
+    error("Can't generate ServiceX package archive")
+  for archive in chart_dir.glob("servicex-*.tgz"):
+    logging.debug(f"moving {archive.name} to {chart_repo_dir / archive.name}")
+    shutil.move(archive, chart_repo_dir / archive.name)
+  if not run_command(["helm", "repo", "index", ".",
+                      "--url", "https://ssl-hep.github.io/ssl-helm-charts/"], chart_repo_dir):
+    error("Can't update chart index")
+
+
+def run_command(args: list[str], cwd: pathlib.Path) -> bool:
+  """
+  Run a command in a directory
+  :param args: command and its arguments
+  :param cwd: directory to run the command in
+  :return: True if the command ran and succeeded, False otherwise
+  """
   try:
-    os.chdir(chart_dir)
-    if os.system("helm dependency update servicex") != 0:
-      error("Can't update helm dependencies for ServiceX")
-    if os.system("helm package servicex") != 0:
-      error("Can't generate ServiceX package archive")
-    for archive in glob.glob("servicex-*.tgz"):
-      print(f"moving {archive} to {chart_repo_dir / archive}")
-      print(f"{chart_repo_dir}")
-      shutil.move(archive, chart_repo_dir / archive)
-    os.chdir(chart_repo_dir)
-    if os.system("helm repo index . --url https://ssl-hep.github.io/ssl-helm-charts/") != 0:
-      error("Can't update chart index")
-    os.system
-  finally:
-    os.chdir(cur_dir)
+    return subprocess.run(args, cwd=cwd).returncode == 0
+  except OSError as e:
+    error(f"Can't run {args[0]}: {e}", abort=False)
+    return False
 
 